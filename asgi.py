@@ -0,0 +1 @@
+from flaskr.asgi import app
@@ -0,0 +1,167 @@
+"""Compare the WSGI app with the ASGI serving mode under concurrency.
+
+Both modes serve the same seeded database in-process: the WSGI app from a
+pool of client threads, the ASGI app from concurrent asyncio tasks. Run from
+the repository root:
+
+    python -m benchmarks.bench_asgi --concurrency 200 --output asgi.json
+
+DATABASE_URL selects the database; by default a fresh SQLite file is used.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+
+from benchmarks.bench_endpoints import ADMIN_TOKEN, git_commit, seed, summarize
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--sessions', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=5000, help='requests per mode')
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=5, help='WSGI client threads, like the uWSGI processes')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    return parser.parse_args()
+
+
+def workload(users):
+    """Yield (method, path, query, form) for a read-heavy dashboard mix."""
+    while True:
+        roll = random.random()
+
+        if roll < 0.5:
+            yield 'GET', '/user/list', 'limit=100', None
+        elif roll < 0.7:
+            yield 'GET', '/onlineusers', '', None
+        else:
+            id = random.randint(2, users)
+            yield 'POST', f'/user/update/{id}', '', {'token': ADMIN_TOKEN, 'lastname': 'async'}
+
+
+def run_wsgi(app, requests, threads, users):
+    latencies = []
+    lock = threading.Lock()
+    remaining = iter(range(requests))
+
+    def client_loop():
+        client = app.test_client()
+        operations = workload(users)
+
+        for _ in remaining:
+            method, path, query, form = next(operations)
+
+            start = time.perf_counter()
+            client.open(path, method=method, query_string=query, data=form)
+            seconds = time.perf_counter() - start
+
+            with lock:
+                latencies.append(seconds)
+
+    workers = [threading.Thread(target=client_loop) for _ in range(threads)]
+
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    return summarize(sorted(latencies), time.perf_counter() - start)
+
+
+async def call_asgi(app, method, path, query, form):
+    from urllib.parse import urlencode
+
+    body = urlencode(form).encode() if form else b''
+    scope = {
+        'type': 'http',
+        'method': method,
+        'path': path,
+        'query_string': query.encode(),
+        'headers': [(b'content-type', b'application/x-www-form-urlencoded')],
+        'client': ('127.0.0.1', 0)
+    }
+    messages = [{'type': 'http.request', 'body': body}]
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        pass
+
+    await app(scope, receive, send)
+
+
+async def run_asgi(app, requests, concurrency, users):
+    latencies = []
+    remaining = iter(range(requests))
+
+    async def client_loop():
+        operations = workload(users)
+
+        for _ in remaining:
+            method, path, query, form = next(operations)
+
+            start = time.perf_counter()
+            await call_asgi(app, method, path, query, form)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+
+    return summarize(sorted(latencies), time.perf_counter() - start)
+
+
+def main():
+    args = parse_args()
+    random.seed(0)
+
+    if 'DATABASE_URL' not in os.environ:
+        directory = tempfile.mkdtemp(prefix='flaskr-bench-')
+        os.environ['DATABASE_URL'] = f'sqlite:///{os.path.join(directory, "bench.db")}'
+
+    from flaskr import create_app
+    from flaskr.asgi import app as asgi_app
+    from flaskr.database import db
+    import flaskr.async_database as async_database
+
+    app = create_app()
+
+    results = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': vars(args),
+        'modes': {}
+    }
+
+    seed(app, db, args.users, args.sessions)
+    results['modes']['wsgi'] = run_wsgi(app, args.requests, args.threads, args.users)
+
+    seed(app, db, args.users, args.sessions)
+
+    async def asgi_mode():
+        async_database.init_engine(app.config['SQLALCHEMY_DATABASE_URI'])
+        try:
+            return await run_asgi(asgi_app, args.requests, args.concurrency, args.users)
+        finally:
+            await async_database.engine.dispose()
+
+    results['modes']['asgi'] = asyncio.run(asgi_mode())
+
+    for name, stats in results['modes'].items():
+        print(f'{name:<5} {stats["throughput_rps"]:8.0f} req/s  p50 {stats["p50_ms"]:8.2f} ms  '
+              f'p95 {stats["p95_ms"]:8.2f} ms  p99 {stats["p99_ms"]:8.2f} ms')
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
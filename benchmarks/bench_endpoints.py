@@ -0,0 +1,445 @@
+"""Load test of every API route against a seeded database.
+
+Seeds a database with N users and M sessions, then replays a weighted mix of
+requests through the WSGI app in-process, first from a single client and then
+from concurrent clients. Reports p50/p95/p99 latency, throughput and SQL
+statements per request for each route, and writes the results as JSON so runs
+can be diffed across commits. Run from the repository root:
+
+    python -m benchmarks.bench_endpoints --users 10000 --sessions 1000 --output bench.json
+
+DATABASE_URL selects the database; by default a fresh SQLite file is used.
+"""
+import argparse
+import collections
+import itertools
+import json
+import os
+import random
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+
+
+ADMIN_TOKEN = 'benchadmin'
+PASSWORD = 'password123'
+# Ids handed out to users created during the run count down from here, well
+# above the seeded ones and out of reach of the autoincrement ids that
+# /user/create users get
+CREATED_ID_START = 10000000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--sessions', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=5000, help='requests per mode')
+    parser.add_argument('--clients', type=int, default=8, help='threads in the concurrent mode')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    return parser.parse_args()
+
+
+def percentile(sorted_values, fraction):
+    if len(sorted_values) == 0:
+        return None
+
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            capture_output=True,
+            text=True,
+            check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class QueryCounter():
+    """Counts SQL statements issued by the current thread."""
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+
+        self.local = threading.local()
+        event.listen(engine, 'before_cursor_execute', self.count)
+
+    def count(self, *args):
+        self.local.queries = getattr(self.local, 'queries', 0) + 1
+
+    def reset(self):
+        self.local.queries = 0
+
+    def value(self):
+        return getattr(self.local, 'queries', 0)
+
+
+class Recorder():
+    def __init__(self):
+        self.samples = collections.defaultdict(list)
+        self.lock = threading.Lock()
+
+    def record(self, route, seconds, status, queries):
+        with self.lock:
+            self.samples[route].append((seconds, status, queries))
+
+    def report(self, elapsed):
+        routes = {}
+
+        for route, samples in sorted(self.samples.items()):
+            latencies = sorted(seconds for seconds, _, _ in samples)
+            routes[route] = summarize(latencies, elapsed) | {
+                'statuses': dict(collections.Counter(str(status) for _, status, _ in samples)),
+                'queries_per_request': statistics.mean(queries for _, _, queries in samples)
+            }
+
+        latencies = sorted(seconds for samples in self.samples.values() for seconds, _, _ in samples)
+
+        return {
+            'elapsed_seconds': elapsed,
+            'total': summarize(latencies, elapsed),
+            'routes': routes
+        }
+
+
+def summarize(latencies, elapsed):
+    return {
+        'count': len(latencies),
+        'throughput_rps': len(latencies) / elapsed if elapsed > 0 else None,
+        'p50_ms': ms(percentile(latencies, 0.50)),
+        'p95_ms': ms(percentile(latencies, 0.95)),
+        'p99_ms': ms(percentile(latencies, 0.99)),
+        'max_ms': ms(latencies[-1] if latencies else None)
+    }
+
+
+def ms(seconds):
+    return None if seconds == None else seconds * 1000
+
+
+class State():
+    """Users and tokens shared by the clients of one run."""
+
+    def __init__(self, users, sessions):
+        self.lock = threading.Lock()
+        # Seeded users 2..sessions are logged in, the rest are free to log in
+        self.logged_in = collections.deque(
+            (id, f'token{id}') for id in range(2, sessions + 1)
+        )
+        self.logged_out = collections.deque(range(sessions + 1, users + 1))
+        self.created = collections.deque()
+        self.next_id = itertools.count(CREATED_ID_START, -1)
+        self.users = users
+
+    def pop(self, queue):
+        with self.lock:
+            return queue.popleft() if queue else None
+
+    def push(self, queue, item):
+        with self.lock:
+            queue.append(item)
+
+
+def new_user(id):
+    return {
+        'id': id,
+        'username': f'b{id}',
+        'email': f'b{id}@example.com',
+        'password': PASSWORD,
+        'firstname': 'bench'
+    }
+
+
+def op_login(client, state):
+    id = state.pop(state.logged_out)
+    if id == None:
+        return None
+
+    response = client.post('/login', data={'username': f'user{id}', 'password': PASSWORD})
+
+    if response.status_code == 200:
+        state.push(state.logged_in, (id, response.get_json()))
+    else:
+        state.push(state.logged_out, id)
+
+    return response
+
+
+def op_logout(client, state):
+    item = state.pop(state.logged_in)
+    if item == None:
+        return None
+
+    id, token = item
+    response = client.post('/logout', data={'token': token})
+    state.push(state.logged_out, id)
+
+    return response
+
+
+def op_list_users(client, state):
+    url = '/user/list?limit=100'
+    after = random.randint(0, state.users)
+
+    if after > 0:
+        from flaskr.backend import encode_cursor
+        url += f'&cursor={encode_cursor(after)}'
+
+    return client.get(url)
+
+
+def op_online_users(client, state):
+    return client.get('/onlineusers')
+
+
+def op_count_online_users(client, state):
+    return client.get('/onlineusers/count')
+
+
+def op_online_user(client, state):
+    # Seeded sessions belong to the lowest ids, so this asks about online
+    # and offline users alike
+    return client.get(f'/onlineusers/{random.randint(1, state.users)}')
+
+
+def op_create(client, state):
+    user = new_user(next(state.next_id))
+    # The form can't carry an int id, so these users are not tracked for deletion
+    del user['id']
+    return client.post('/user/create', data=user)
+
+
+def op_bulk_create(client, state):
+    users = [new_user(next(state.next_id)) for _ in range(10)]
+    response = client.post('/user/bulk-create', json=users)
+
+    if response.status_code != 200:
+        return response
+
+    failed = {row['index'] for row in response.get_json()['failed']}
+
+    for index, user in enumerate(users):
+        if index not in failed:
+            state.push(state.created, user['id'])
+
+    return response
+
+
+def op_update(client, state):
+    id = random.randint(2, state.users)
+    return client.post(f'/user/update/{id}', data={'token': ADMIN_TOKEN, 'lastname': 'updated'})
+
+
+def op_bulk_update(client, state):
+    ids = random.sample(range(2, state.users + 1), min(10, state.users - 1))
+    return client.post('/user/update', json={
+        'token': ADMIN_TOKEN,
+        'users': [{'id': id, 'middlename': 'bulk'} for id in ids]
+    })
+
+
+def op_delete(client, state):
+    id = state.pop(state.created)
+    if id == None:
+        return None
+
+    # Deleting a user also ends the caller's session, so spend a regular one
+    item = state.pop(state.logged_in)
+    if item == None:
+        state.push(state.created, id)
+        return None
+
+    caller, token = item
+    response = client.post(f'/user/delete/{id}', data={'token': token})
+    state.push(state.logged_out, caller)
+
+    return response
+
+
+def op_bulk_delete(client, state):
+    ids = [id for id in (state.pop(state.created) for _ in range(10)) if id != None]
+    if len(ids) == 0:
+        return None
+
+    return client.post('/user/delete', json={'token': ADMIN_TOKEN, 'ids': ids})
+
+
+def op_pool_metrics(client, state):
+    return client.get('/pool/metrics')
+
+
+def op_metrics(client, state):
+    return client.get('/metrics')
+
+
+# (route, operation, weight) of the mixed workload
+WORKLOAD = [
+    ('/login', op_login, 10),
+    ('/logout', op_logout, 10),
+    ('/user/list', op_list_users, 20),
+    ('/onlineusers', op_online_users, 5),
+    ('/onlineusers/count', op_count_online_users, 5),
+    ('/onlineusers/<int:id>', op_online_user, 5),
+    ('/user/create', op_create, 5),
+    ('/user/bulk-create', op_bulk_create, 2),
+    ('/user/update/<int:id>', op_update, 10),
+    ('/user/update', op_bulk_update, 2),
+    ('/user/delete/<int:id>', op_delete, 5),
+    ('/user/delete', op_bulk_delete, 1),
+    ('/pool/metrics', op_pool_metrics, 1),
+    ('/metrics', op_metrics, 1)
+]
+
+
+def seed(app, db, users, sessions):
+    from sqlalchemy import insert
+    import flaskr.hashing as hashing
+    import flaskr.presence as presence
+    import flaskr.versions as versions
+    from flaskr.database import User, Session, online_user_ids
+    import datetime as dt
+
+    # scrypt salts are random rather than derived from the username, so one
+    # hash serves every seeded user without paying the KDF cost N times
+    password = hashing.hash_password(PASSWORD, None)
+
+    with app.app_context():
+        db.drop_all(bind_key=None)
+        db.create_all(bind_key=None)
+
+        rows = [{
+            'id': id,
+            'username': f'user{id}',
+            'email': f'user{id}@example.com',
+            'password': password,
+            'firstname': 'seed'
+        } for id in range(1, users + 1)]
+
+        for start in range(0, len(rows), 1000):
+            db.session.execute(insert(User), rows[start:start + 1000])
+
+        now = dt.datetime.now()
+        db.session.execute(insert(Session), [{
+            'created_at': now,
+            'last_seen_at': now,
+            'ip': '127.0.0.1',
+            'user_id': id,
+            'token': ADMIN_TOKEN if id == 1 else f'token{id}'
+        } for id in range(1, sessions + 1)])
+
+        db.session.commit()
+
+        # The rows went in behind the app's back: orphan responses cached
+        # from the previous seed and reload the online users, as a restart
+        # would
+        versions.bump('user', 'session')
+        presence.rebuild(online_user_ids)
+
+
+def run_mode(app, counter, state, requests, clients):
+    recorder = Recorder()
+    operations = [(route, op) for route, op, _ in WORKLOAD]
+    weights = [weight for _, _, weight in WORKLOAD]
+    remaining = itertools.count()
+
+    def client_loop():
+        client = app.test_client()
+
+        while next(remaining) < requests:
+            route, op = random.choices(operations, weights)[0]
+
+            counter.reset()
+            start = time.perf_counter()
+            response = op(client, state)
+            seconds = time.perf_counter() - start
+
+            if response != None:
+                recorder.record(route, seconds, response.status_code, counter.value())
+
+    threads = [threading.Thread(target=client_loop) for _ in range(clients)]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return recorder.report(time.perf_counter() - start)
+
+
+def uncovered_routes(app):
+    covered = {route for route, _, _ in WORKLOAD}
+    return sorted(rule.rule for rule in app.url_map.iter_rules() if rule.endpoint != 'static' and rule.rule not in covered)
+
+
+def print_report(name, report):
+    print(f'== {name}: {report["total"]["count"]} requests in {report["elapsed_seconds"]:.2f}s '
+          f'({report["total"]["throughput_rps"]:.0f} req/s)')
+    print(f'{"route":<24} {"count":>6} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"queries":>8}  statuses')
+
+    for route, stats in report['routes'].items():
+        print(f'{route:<24} {stats["count"]:>6} {stats["p50_ms"]:>8.2f} {stats["p95_ms"]:>8.2f} '
+              f'{stats["p99_ms"]:>8.2f} {stats["queries_per_request"]:>8.2f}  {stats["statuses"]}')
+
+    print()
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+
+    if 'DATABASE_URL' not in os.environ:
+        directory = tempfile.mkdtemp(prefix='flaskr-bench-')
+        os.environ['DATABASE_URL'] = f'sqlite:///{os.path.join(directory, "bench.db")}'
+
+    from flaskr import create_app
+    from flaskr.database import db
+    import flaskr.ratelimit as ratelimit
+
+    app = create_app()
+
+    # Every simulated client logs in from the same address
+    ratelimit.configure(
+        path=app.config['LOGIN_RATE_LIMIT_PATH'],
+        slots=app.config['LOGIN_RATE_LIMIT_SLOTS'],
+        ip_limit=None,
+        username_limit=None
+    )
+
+    with app.app_context():
+        engine = db.engine
+
+    counter = QueryCounter(engine)
+    results = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'database': engine.dialect.name,
+        'config': vars(args),
+        'modes': {}
+    }
+
+    for rule in uncovered_routes(app):
+        print(f'Warning: no workload for route {rule}')
+
+    for name, clients in (('sequential', 1), ('concurrent', args.clients)):
+        seed(app, db, args.users, args.sessions)
+        state = State(args.users, args.sessions)
+
+        report = run_mode(app, counter, state, args.requests, clients)
+        results['modes'][name] = report
+        print_report(name, report)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
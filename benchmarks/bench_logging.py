@@ -0,0 +1,73 @@
+"""Microbenchmark of the logging cost of one request.
+
+Compares the queue-backed pipeline from flaskr.logs against synchronous,
+eagerly formatted logging like the app used to do. Run from the repository
+root:
+
+    python -m benchmarks.bench_logging
+"""
+import logging
+import os
+import timeit
+
+from flaskr.logs import setup_logging, stop_logging
+
+
+REQUEST = {
+    'username': 'name',
+    'password': '123456',
+    'ip': '127.0.0.1'
+}
+
+
+def lazy_request():
+    # Roughly the messages a POST /login emits
+    access = logging.getLogger('flaskr.resources')
+    backend = logging.getLogger('flaskr.backend')
+
+    access.info('POST /login from %s', REQUEST['ip'])
+    backend.debug('Using schema %s', 'LoginFormSchema')
+    backend.debug('Trying to validate with %s...', 'LoginFormSchema')
+    backend.debug('Valid!')
+    backend.debug('Calling %s with %s', 'login', REQUEST)
+    backend.debug('Created session %s', REQUEST)
+
+
+def eager_request():
+    logging.info(f'POST /login: {REQUEST}')
+    logging.info(f'Using schema LoginFormSchema on data {str(REQUEST)}')
+    logging.info(f'Trying to validate {REQUEST} with LoginFormSchema...')
+    logging.info('Valid!')
+    logging.info(f'Calling login with {REQUEST}')
+    logging.debug(REQUEST)
+
+
+def measure(func, number):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def run(number=20000):
+    results = {}
+
+    with open(os.devnull, 'w') as devnull:
+        root = logging.getLogger()
+        handler = logging.StreamHandler(devnull)
+        root.addHandler(handler)
+        root.setLevel(logging.DEBUG)
+        results['eager, synchronous'] = measure(eager_request, number)
+        root.removeHandler(handler)
+
+        setup_logging({'LOG_LEVEL': 'INFO'}, stream=devnull)
+        results['lazy, queued'] = measure(lazy_request, number)
+        stop_logging()
+
+        setup_logging({'LOG_LEVEL': 'INFO', 'LOG_SAMPLING': {'flaskr.resources': 0.1}}, stream=devnull)
+        results['lazy, queued, sampled'] = measure(lazy_request, number)
+        stop_logging()
+
+    return results
+
+
+if __name__ == '__main__':
+    for name, microseconds in run().items():
+        print(f'{name:<24} {microseconds:8.2f} us/request')
@@ -0,0 +1,40 @@
+"""Microbenchmark of the per-request metrics recording overhead.
+
+Times what every request pays: start_request, two cursor events for one SQL
+statement and finish_request into the shared memory block. Run from the
+repository root:
+
+    python -m benchmarks.bench_metrics
+"""
+import os
+import tempfile
+import timeit
+
+
+class FakeConnection():
+    def __init__(self):
+        self.info = {}
+
+
+def one_request(metrics, connection):
+    started = metrics.start_request()
+    metrics.before_cursor_execute(connection, None, None, None, None, False)
+    metrics.after_cursor_execute(connection, None, None, None, None, False)
+    metrics.finish_request(started, '/user/list', 200)
+
+
+def run(number=200000):
+    directory = tempfile.mkdtemp(prefix='flaskr-bench-')
+
+    import flaskr.metrics as metrics
+
+    metrics.configure(os.path.join(directory, 'metrics'), ['/login', '/user/list', '/onlineusers'])
+    connection = FakeConnection()
+
+    seconds = min(timeit.repeat(lambda: one_request(metrics, connection), number=number, repeat=5))
+
+    return seconds / number * 1e6
+
+
+if __name__ == '__main__':
+    print(f'metrics recording {run():8.2f} us/request')
@@ -0,0 +1,58 @@
+"""Microbenchmark of per-request schema validation.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_schemas
+"""
+import timeit
+
+from flaskr.schemas import LoginFormSchema, NewUserDataSchema, UserModificationSchema
+
+
+CASES = {
+    'LoginFormSchema': (LoginFormSchema, {
+        'username': 'name',
+        'password': '123456',
+        'ip': '127.0.0.1'
+    }),
+    'NewUserDataSchema': (NewUserDataSchema, {
+        'username': 'name',
+        'email': 'mail@example.com',
+        'password': '123456',
+        'firstname': 'john',
+        'middlename': 'b',
+        'lastname': 'doe',
+        'birthdate': '2000-01-01'
+    }),
+    'UserModificationSchema': (UserModificationSchema, {
+        'token': 'abcdefghijklmnop',
+        'firstname': 'john',
+        'email': 'mail@example.com',
+        'id': 1
+    })
+}
+
+
+def validate_and_serialize(schema, data):
+    # What use_schema does for every request
+    schema.validate(data)
+    return schema.serialize(data)
+
+
+def run(number=100000):
+    results = {}
+
+    for name, (schema, data) in CASES.items():
+        seconds = min(timeit.repeat(
+            lambda: validate_and_serialize(schema, data),
+            number=number,
+            repeat=5
+        ))
+        results[name] = seconds / number * 1e6
+
+    return results
+
+
+if __name__ == '__main__':
+    for name, microseconds in run().items():
+        print(f'{name:<24} {microseconds:8.2f} us/request')
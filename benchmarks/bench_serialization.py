@@ -0,0 +1,97 @@
+"""Compare the ORM + stdlib json path with the Core + orjson path on large lists.
+
+Builds the /user/list and /onlineusers bodies both ways from the same seeded
+database and reports requests per second for each. Run from the repository
+root:
+
+    python -m benchmarks.bench_serialization --users 1000 --sessions 1000
+
+DATABASE_URL selects the database; by default a fresh SQLite file is used.
+"""
+import argparse
+import json
+import os
+import tempfile
+import timeit
+
+from benchmarks.bench_endpoints import seed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=1000, help='rows per /user/list page')
+    parser.add_argument('--sessions', type=int, default=1000)
+    parser.add_argument('--number', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=7, help='best of this many timing runs')
+    return parser.parse_args()
+
+
+def fresh(func):
+    """Run func with an empty identity map, as each request starts with, so
+    the ORM path hydrates every row rather than finding it already loaded."""
+    from flaskr.database import db
+
+    def run():
+        try:
+            return func()
+        finally:
+            db.session.expunge_all()
+
+    return run
+
+
+def orm_users(limit):
+    from flaskr.database import User
+
+    return json.dumps([x.serialize() for x in User.query.order_by(User.id).limit(limit).all()]) + '\n'
+
+
+def orm_sessions():
+    from flaskr.database import Session, User, db
+
+    rows = db.session.query(Session, User.username).join(User, Session.user_id == User.id).all()
+
+    return json.dumps([session.serialize() | {'username': username} for session, username in rows]) + '\n'
+
+
+def main():
+    args = parse_args()
+
+    if 'DATABASE_URL' not in os.environ:
+        directory = tempfile.mkdtemp(prefix='flaskr-bench-')
+        os.environ['DATABASE_URL'] = f'sqlite:///{os.path.join(directory, "bench.db")}'
+
+    from flaskr import create_app
+    from flaskr.database import db
+    from flaskr.representations import dumps
+    import flaskr.database as database
+
+    app = create_app()
+
+    seed(app, db, args.users, args.sessions)
+
+    cases = {
+        '/user/list': (
+            fresh(lambda: orm_users(args.users)),
+            lambda: dumps(database.list_users(limit=args.users))
+        ),
+        '/onlineusers': (
+            fresh(orm_sessions),
+            lambda: dumps(database.list_sessions())
+        )
+    }
+
+    with app.app_context():
+        for route, (before, after) in cases.items():
+            rates = []
+
+            for func in (before, after):
+                seconds = min(timeit.repeat(func, number=args.number, repeat=args.repeat))
+                rates.append(args.number / seconds)
+
+            print(f'{route:<14} orm+json {rates[0]:8.1f} req/s  core+orjson {rates[1]:8.1f} req/s  '
+                  f'speedup {rates[1] / rates[0]:5.1f}x')
+
+
+if __name__ == '__main__':
+    main()
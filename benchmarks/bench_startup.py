@@ -0,0 +1,138 @@
+"""Startup cost of the app and of a freshly forked worker.
+
+Each run starts a new interpreter and times importing flaskr, building the
+app with create_app(), then forks a worker the way a uWSGI master with
+lazy-apps off does and times that worker's first two requests, with and
+without pool pre-warming. Medians over the runs are reported. Run from the
+repository root:
+
+    python -m benchmarks.bench_startup --runs 5 --output startup.json
+
+DATABASE_URL selects the database; by default a fresh SQLite file is used.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--measure', action='store_true', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def measure():
+    """Runs in a fresh interpreter; prints one result as JSON."""
+    started = time.perf_counter()
+    import flaskr
+    imported = time.perf_counter()
+    app = flaskr.create_app({'SESSION_SWEEP_INTERVAL': 0})
+    created = time.perf_counter()
+
+    from flaskr.pool import run_worker_hooks
+
+    read, write = os.pipe()
+    pid = os.fork()
+
+    if pid == 0:
+        # What uWSGI's postfork hook does in each new worker
+        run_worker_hooks()
+        client = app.test_client()
+        timings = []
+
+        for _ in range(2):
+            request_started = time.perf_counter()
+            client.get('/user/list')
+            timings.append(time.perf_counter() - request_started)
+
+        os.write(write, json.dumps(timings).encode())
+        os._exit(0)
+
+    os.close(write)
+    os.waitpid(pid, 0)
+
+    with os.fdopen(read) as pipe:
+        first, second = json.load(pipe)
+
+    print(json.dumps({
+        'import_ms': (imported - started) * 1000,
+        'create_app_ms': (created - imported) * 1000,
+        'first_request_ms': first * 1000,
+        'second_request_ms': second * 1000
+    }))
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def create_schema(url):
+    from sqlalchemy import create_engine
+    from flaskr.database import db
+
+    engine = create_engine(url)
+    db.metadata.create_all(engine)
+    engine.dispose()
+
+
+def run_mode(runs, prewarm):
+    env = dict(os.environ)
+    env.pop('DB_POOL_PREWARM', None)
+
+    if prewarm != None:
+        env['DB_POOL_PREWARM'] = str(prewarm)
+
+    samples = []
+
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.bench_startup', '--measure'],
+            env=env, capture_output=True, text=True, check=True
+        )
+        samples.append(json.loads(result.stdout.splitlines()[-1]))
+
+    return {key: statistics.median(sample[key] for sample in samples) for key in samples[0]}
+
+
+def main():
+    args = parse_args()
+
+    if args.measure:
+        return measure()
+
+    if 'DATABASE_URL' not in os.environ:
+        directory = tempfile.mkdtemp(prefix='flaskr-bench-')
+        os.environ['DATABASE_URL'] = f'sqlite:///{os.path.join(directory, "bench.db")}'
+
+    create_schema(os.environ['DATABASE_URL'])
+
+    results = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': vars(args),
+        'modes': {}
+    }
+
+    for name, prewarm in (('cold', 0), ('prewarmed', None)):
+        stats = run_mode(args.runs, prewarm)
+        results['modes'][name] = stats
+        print(f'{name:<10} import {stats["import_ms"]:8.1f} ms  create_app {stats["create_app_ms"]:8.1f} ms  '
+              f'first request {stats["first_request_ms"]:8.2f} ms  second {stats["second_request_ms"]:8.2f} ms')
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1 @@
+curl -X POST --URL 127.0.0.1/user/bulk-create -H "Content-Type: application/x-ndjson" --data-binary @users.ndjson
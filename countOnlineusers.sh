@@ -0,0 +1 @@
+curl --URL 127.0.0.1/onlineusers/count
@@ -0,0 +1,400 @@
+"""ASGI serving mode exposing the same routes as the Flask app.
+
+Requests are handled on an event loop with an async database driver, so a
+worker can keep thousands of connections open while they wait on the
+database. Serve it with any ASGI server, e.g.:
+
+    uvicorn asgi:app --workers 5
+"""
+from werkzeug.exceptions import BadRequest, HTTPException
+from werkzeug.http import parse_etags
+from urllib.parse import parse_qsl
+import flaskr.async_backend as backend
+from flaskr.backend import abort_if_rate_limited
+import flaskr.async_database as database
+from flaskr.logs import setup_logging
+from flaskr.representations import dumps
+import flaskr.metrics as metrics
+import flaskr.presence as presence
+import flaskr.response_cache as response_cache
+import flaskr.sweeper as sweeper
+import asyncio
+import datetime as dt
+import json
+import logging
+import os
+import re
+
+
+logger = logging.getLogger(__name__)
+
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/ndjson')
+
+
+class Request():
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.ip = (scope.get('client') or ('127.0.0.1', 0))[0]
+        self.headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope.get('headers', [])}
+        self.mimetype = self.headers.get('content-type', '').split(';')[0].strip()
+        self.query = parse_qsl(scope.get('query_string', b'').decode(), keep_blank_values=True)
+        self.args = first_values(self.query)
+        self.body = body
+
+    @property
+    def form(self):
+        if self.mimetype != 'application/x-www-form-urlencoded':
+            return {}
+
+        return first_values(parse_qsl(self.body.decode()))
+
+    def get_json(self):
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            raise BadRequest('Failed to decode JSON object') from None
+
+
+def first_values(pairs):
+    # Same as dict(request.form) on a werkzeug MultiDict
+    result = {}
+
+    for key, value in pairs:
+        result.setdefault(key, value)
+
+    return result
+
+
+def read_ndjson(body):
+    for line in body.splitlines():
+        if line.strip() == b'':
+            continue
+
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield None
+
+
+async def cached(request, tables, compute):
+    """flaskr.response_cache.cached_response for a handler; compute is a
+    coroutine function."""
+    etag = response_cache.make_etag(request.path, tables, request.query)
+    headers = [('ETag', f'"{etag}"')]
+
+    if parse_etags(request.headers.get('if-none-match')).contains(etag):
+        return b'', 304, headers
+
+    body = response_cache.cached_body(etag)
+
+    if body == None:
+        body = response_cache.store(etag, await compute())
+
+    return body, 200, headers
+
+
+async def login(request):
+    abort_if_rate_limited(ip=request.ip, username=request.form.get('username'))
+    return await backend.login(request.form | {'ip': request.ip}), 200
+
+
+async def logout(request):
+    await backend.logout(request.form)
+    return '', 204
+
+
+async def user_list(request):
+    return await cached(request, ['user'], lambda: backend.list_users({
+        'limit': request.args.get('limit'),
+        'cursor': request.args.get('cursor'),
+        'fields': request.args.get('fields')
+    }))
+
+
+async def user_create(request):
+    await backend.create_user(request.form)
+    return '', 204
+
+
+async def user_bulk_create(request):
+    if request.mimetype in NDJSON_MIMETYPES:
+        users = list(read_ndjson(request.body))
+    else:
+        users = request.get_json()
+
+        if not isinstance(users, list):
+            return {'message': 'Expected a JSON array or an NDJSON stream of users'}, 400
+
+    return await backend.create_users(users), 200
+
+
+async def user_delete(request, id):
+    await backend.delete_user(request.form | {'id': int(id)})
+    return '', 204
+
+
+async def user_update(request, id):
+    await backend.modify_user(request.form | {'id': int(id)})
+    return '', 204
+
+
+async def user_bulk_delete(request):
+    return await backend.delete_users(request.get_json()), 200
+
+
+async def user_bulk_update(request):
+    await backend.modify_users(request.get_json())
+    return '', 204
+
+
+async def online_users(request):
+    return await cached(request, ['session', 'user'], lambda: backend.list_onlineusers({
+        'fields': request.args.get('fields')
+    }))
+
+
+async def online_user_count(request):
+    return await backend.count_onlineusers(), 200
+
+
+async def online_user(request, id):
+    return await backend.get_onlineuser(int(id)), 200
+
+
+async def pool_metrics(request):
+    pool = database.engine.sync_engine.pool
+
+    return {
+        'pid': os.getpid(),
+        'pools': [{
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'checked_in': pool.checkedin(),
+            'overflow': pool.overflow()
+        }]
+    }, 200
+
+
+async def metrics_text(request):
+    return metrics.export().encode(), 200, [('Content-Type', 'text/plain; version=0.0.4')]
+
+
+# Mirrors the api.add_resource calls in flaskr/__init__.py
+ROUTES = [
+    ('POST', '/login', login),
+    ('POST', '/logout', logout),
+    ('GET', '/user/list', user_list),
+    ('POST', '/user/create', user_create),
+    ('POST', '/user/bulk-create', user_bulk_create),
+    ('POST', '/user/delete/(?P<id>[0-9]+)', user_delete),
+    ('POST', '/user/update/(?P<id>[0-9]+)', user_update),
+    ('POST', '/user/delete', user_bulk_delete),
+    ('POST', '/user/update', user_bulk_update),
+    ('GET', '/onlineusers', online_users),
+    ('GET', '/onlineusers/count', online_user_count),
+    ('GET', '/onlineusers/(?P<id>[0-9]+)', online_user),
+    ('GET', '/pool/metrics', pool_metrics),
+    ('GET', '/metrics', metrics_text)
+]
+
+
+def route_label(pattern):
+    # '/user/delete/(?P<id>[0-9]+)' -> '/user/delete/<int:id>', the Flask rule
+    return re.sub(r'\(\?P<(\w+)>\[0-9\]\+\)', r'<int:\1>', pattern)
+
+
+COMPILED_ROUTES = [(method, re.compile(f'^{pattern}$'), handler, route_label(pattern)) for method, pattern, handler in ROUTES]
+
+
+def resolve(method, path):
+    allowed = False
+
+    for route_method, pattern, handler, label in COMPILED_ROUTES:
+        match = pattern.match(path)
+
+        if match == None:
+            continue
+
+        if route_method == method:
+            return handler, match.groupdict(), 200, label
+
+        allowed = True
+
+    return None, None, 405 if allowed else 404, None
+
+
+async def read_body(receive):
+    body = b''
+
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+
+        if not message.get('more_body', False):
+            return body
+
+
+# Headers of an HTTPException that are passed on, e.g. a 429's Retry-After
+FORWARDED_ERROR_HEADERS = ('Retry-After', 'WWW-Authenticate')
+
+
+async def send_response(send, body, status, extra_headers=()):
+    """body is a JSON-serializable value or an already rendered bytes body;
+    extra_headers may override its application/json content type."""
+    names = {k.lower() for k, v in extra_headers}
+
+    if status in (204, 304):
+        payload = b''
+        headers = []
+    else:
+        payload = body if isinstance(body, bytes) else dumps(body)
+        headers = [] if 'content-type' in names else [(b'content-type', b'application/json')]
+
+    headers += [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in extra_headers]
+
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': headers + [(b'content-length', str(len(payload)).encode())]
+    })
+    await send({'type': 'http.response.body', 'body': payload})
+
+
+config = None
+startup = None
+sweeper_task = None
+
+
+async def start():
+    """Set the worker up from the app's settings (see flaskr.build_config):
+    the shared modules, logging, metrics and the database engines, then the
+    presence registry and the session sweeper. Unlike create_app() this
+    builds no Flask app; the other routes' setup isn't needed here."""
+    global config, sweeper_task
+
+    from flaskr import build_config, configure_modules
+
+    config = build_config()
+
+    setup_logging(config)
+    configure_modules(config)
+    metrics.configure(
+        path=config['METRICS_PATH'],
+        resources=sorted(label for method, pattern, handler, label in COMPILED_ROUTES)
+    )
+
+    binds = config['SQLALCHEMY_BINDS']
+    database.init_engine(
+        config['SQLALCHEMY_DATABASE_URI'],
+        replica_urls={key: binds[key]['url'] for key in binds if key.startswith('replica')}
+    )
+
+    await rebuild_presence()
+
+    if config['SESSION_SWEEP_INTERVAL']:
+        sweeper_task = asyncio.get_running_loop().create_task(run_sweeper())
+
+    logger.info('Server ready!')
+
+
+async def ensure_started():
+    # Requests arriving before startup has finished wait for it, as do all
+    # requests on servers run without the lifespan protocol
+    global startup
+
+    if startup == None:
+        startup = asyncio.ensure_future(start())
+
+    await startup
+
+
+async def rebuild_presence():
+    # Like presence.rebuild(), with the ids loaded on the event loop
+    try:
+        with presence.registry.rebuilding() as replace:
+            replace(await database.online_user_ids())
+    except Exception as e:
+        logger.warning('Couldn\'t rebuild the presence registry: %r', e)
+
+
+async def sweep_expired_sessions(batch_size):
+    total = 0
+
+    for column, cutoff in sweeper.expired_cutoffs(dt.datetime.now()):
+        while True:
+            deleted = await database.delete_expired_sessions(column, cutoff, batch_size)
+            total += deleted
+
+            if deleted < batch_size:
+                break
+
+    return total
+
+
+async def run_sweeper():
+    # flaskr.sweeper.SessionSweeper as a task
+    while True:
+        await asyncio.sleep(config['SESSION_SWEEP_INTERVAL'])
+
+        try:
+            with sweeper.sweep_lock(config['SESSION_SWEEP_LOCK_PATH']) as locked:
+                deleted = await sweep_expired_sessions(config['SESSION_SWEEP_BATCH_SIZE']) if locked else 0
+        except Exception:
+            logger.exception('Session sweep failed')
+            continue
+
+        if deleted > 0:
+            logger.info('Swept %d expired sessions', deleted)
+
+
+async def stop():
+    if sweeper_task != None:
+        sweeper_task.cancel()
+
+    await database.dispose_engines()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+
+        if message['type'] == 'lifespan.startup':
+            await ensure_started()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await stop()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    await ensure_started()
+
+    handler, params, status, label = resolve(scope['method'], scope['path'])
+
+    if handler == None:
+        return await send_response(send, {'message': 'Not found' if status == 404 else 'Method not allowed'}, status)
+
+    request = Request(scope, await read_body(receive))
+
+    headers = []
+    started = metrics.start_request()
+
+    try:
+        body, status, *rest = await handler(request, **params)
+        headers = rest[0] if rest else []
+    except HTTPException as e:
+        body = getattr(e, 'data', None) or {'message': e.description}
+        status = e.code or 400
+        headers = [(k, v) for k, v in e.get_headers() if k in FORWARDED_ERROR_HEADERS]
+    except Exception:
+        logger.exception('Unhandled error on %s %s', scope['method'], scope['path'])
+        body, status = {'message': 'Internal Server Error'}, 500
+
+    metrics.finish_request(started, label, status)
+
+    await send_response(send, body, status, headers)
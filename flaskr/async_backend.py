@@ -0,0 +1,240 @@
+"""Async versions of the flaskr.backend operations for the ASGI mode.
+
+Validation, error responses and password handling are shared with
+flaskr.backend; only the database calls are awaited, and CPU-heavy hashing
+is pushed off the event loop.
+"""
+from flask_restful import abort
+from flaskr.backend import HASHING_BUSY_MESSAGE, abort_if_cant_validate, abort_if_password_isnt_complex, bulk_batches, bulk_result, count_inserted, fail_batch, hash_bulk_passwords, hide_plaintext_password, login_token, new_session_data, page_query, parse_fields, revoke_users, users_page, with_cursor_field
+from flaskr.schemas import FieldSelectionSchema, ListPageSchema, LoginFormSchema, NewUserDataSchema, TokenDataSchema, UserBulkDeletionSchema, UserBulkModificationSchema, UserDataSchema, UserDeletionSchema, UserModificationSchema, UserPatchSchema
+import flaskr.async_database as database
+import flaskr.database as models
+import flaskr.hashing as hashing
+import flaskr.presence as presence
+import flaskr.tokens as tokens
+import asyncio
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+def validate(schema, data):
+    abort_if_cant_validate(data=data, schema=schema)
+    return schema.serialize(data)
+
+
+async def abort_if_cant_login_with_token(token):
+    if tokens.enabled():
+        session = tokens.verify(token)
+    else:
+        session = await database.get_session_by_token(token=token)
+
+    if session == None:
+        abort(401, message=f'Invalid token: {token}')
+
+    return session
+
+
+async def end_session(token, session):
+    if tokens.enabled():
+        tokens.revoke_session(session)
+        await database.delete_session_by_id(session.get('id'))
+    else:
+        await database.delete_session(token)
+
+
+async def abort_if_cant_login_with_credentials(username, password):
+    user = await database.get_user_by_username(username=username)
+
+    if user == None:
+        abort(401, message='Wrong username')
+
+    try:
+        verified = await asyncio.to_thread(hashing.verify_password, password, user.password, username)
+    except hashing.PoolSaturated:
+        abort(503, message=HASHING_BUSY_MESSAGE)
+
+    if verified == False:
+        abort(401, message=f'Wrong credentials: {username}')
+
+    return user
+
+
+async def rehash_if_needed(user, password):
+    if not hashing.needs_rehash(user.password):
+        return
+
+    try:
+        rehashed = await asyncio.to_thread(hashing.hash_password, password, user.username)
+        await database.modify_users([{'id': user.id, 'password': rehashed}])
+    except Exception as e:
+        logger.warning('Couldn\'t rehash the password of user %s: %r', user.id, e)
+
+
+async def login(login_form):
+    login_form = validate(LoginFormSchema, login_form)
+
+    user = await abort_if_cant_login_with_credentials(
+        username=login_form.get('username'),
+        password=login_form.get('password')
+    )
+
+    await rehash_if_needed(user=user, password=login_form.get('password'))
+
+    session_data = new_session_data(ip=login_form.get('ip'))
+
+    try:
+        session_id = await database.insert_session_for_user(user_id=user.id, session_data=session_data)
+    except Exception as e:
+        abort(500, message=repr(e))
+
+    return login_token(user.id, session_id, session_data)
+
+
+async def logout(token_data):
+    token_data = validate(TokenDataSchema, token_data)
+
+    session = await abort_if_cant_login_with_token(token=token_data.get('token'))
+
+    try:
+        await end_session(token_data.get('token'), session)
+    except Exception as e:
+        abort(500, message=repr(e))
+
+
+async def create_user(user):
+    user = validate(NewUserDataSchema, user)
+
+    abort_if_password_isnt_complex(password=user.get('password'))
+
+    user = await asyncio.to_thread(hide_plaintext_password, user)
+
+    try:
+        await database.insert_user(user)
+    except Exception as e:
+        abort(500, message=repr(e))
+
+
+async def create_users(users):
+    created = 0
+    failed = []
+
+    for batch in bulk_batches(users, failed):
+        try:
+            await asyncio.to_thread(hash_bulk_passwords, batch)
+            inserted = await database.insert_users([user for _, user in batch])
+        except Exception as e:
+            fail_batch(batch, e, failed)
+            continue
+
+        created += count_inserted(batch, inserted, failed)
+
+    return bulk_result(created, failed)
+
+
+async def delete_user(user_deletion):
+    user_deletion = validate(UserDeletionSchema, user_deletion)
+
+    session = await abort_if_cant_login_with_token(token=user_deletion.get('token'))
+
+    try:
+        try:
+            await end_session(user_deletion.get('token'), session)
+        except Exception:
+            pass
+
+        await database.delete_users([user_deletion.get('id')])
+    except Exception as e:
+        abort(500, message=repr(e))
+
+    revoke_users([user_deletion.get('id')])
+
+
+async def modify_user(user_modification):
+    user_modification = validate(UserModificationSchema, user_modification)
+
+    await abort_if_cant_login_with_token(token=user_modification.get('token'))
+
+    try:
+        await database.modify_users([UserDataSchema.serialize(user_modification)])
+    except Exception as e:
+        abort(500, message=repr(e))
+
+
+async def delete_users(user_deletion):
+    user_deletion = validate(UserBulkDeletionSchema, user_deletion)
+
+    await abort_if_cant_login_with_token(token=user_deletion.get('token'))
+
+    try:
+        deleted = await database.delete_users(user_deletion.get('ids'))
+    except Exception as e:
+        abort(500, message=repr(e))
+
+    revoke_users(user_deletion.get('ids'))
+
+    return {
+        'deleted': deleted
+    }
+
+
+async def modify_users(user_modification):
+    user_modification = validate(UserBulkModificationSchema, user_modification)
+
+    await abort_if_cant_login_with_token(token=user_modification.get('token'))
+
+    try:
+        await database.modify_users([UserPatchSchema.serialize(x) for x in user_modification.get('users')])
+    except Exception as e:
+        abort(500, message=repr(e))
+
+
+async def list_users(page):
+    limit, fields, after_id = page_query(validate(ListPageSchema, page))
+
+    try:
+        users = await database.list_users(after_id=after_id, limit=limit + 1, fields=with_cursor_field(fields))
+    except Exception as e:
+        abort(500, message=repr(e))
+
+    return users_page(users, limit, fields)
+
+
+async def list_onlineusers(selection):
+    selection = validate(FieldSelectionSchema, selection)
+    fields = parse_fields(selection.get('fields'), models.SESSION_FIELDS)
+
+    try:
+        return await database.list_sessions(fields=fields)
+    except Exception as e:
+        abort(500, message=repr(e))
+
+
+async def count_onlineusers():
+    count = presence.count()
+
+    if count == None:
+        try:
+            count = await database.count_online_users()
+        except Exception as e:
+            abort(500, message=repr(e))
+
+    return {
+        'count': count
+    }
+
+
+async def get_onlineuser(id):
+    online = presence.is_online(id)
+
+    if online == None:
+        try:
+            online = await database.is_user_online(id)
+        except Exception as e:
+            abort(500, message=repr(e))
+
+    return {
+        'id': id,
+        'online': online
+    }
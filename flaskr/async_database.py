@@ -0,0 +1,294 @@
+"""Async counterparts of the flaskr.database functions used by the ASGI mode.
+
+They execute the statements flaskr.database builds, through SQLAlchemy's
+asyncio engine (asyncpg on PostgreSQL, aiosqlite on SQLite), and finish
+with the same bookkeeping, so only the awaiting is written twice.
+"""
+from flaskr.database import User, Session, session_cache, session_expiry
+from flaskr.pool import engine_options_from_env
+from flaskr.replicas import CONNECTION_ERRORS
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.ext.asyncio import create_async_engine
+import flaskr.database as shared
+import flaskr.replicas as replicas
+import datetime as dt
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite'
+}
+
+engine = None
+
+# Bind key -> async engine of each read replica
+replica_engines = {}
+
+
+def async_url(url):
+    scheme, rest = url.split('://', 1)
+    dialect = scheme.split('+')[0]
+
+    return f'{ASYNC_DRIVERS.get(dialect, scheme)}://{rest}'
+
+
+def create_engine(url):
+    options = engine_options_from_env(url)
+    # The async engine brings its own asyncio-aware pool
+    options.pop('poolclass', None)
+
+    return create_async_engine(async_url(url), **options)
+
+
+def init_engine(url, replica_urls=None):
+    """replica_urls maps the bind keys configured in flaskr.replicas to URLs."""
+    global engine, replica_engines
+
+    engine = create_engine(url)
+    replica_engines = {key: create_engine(replica_url) for key, replica_url in (replica_urls or {}).items()}
+
+    return engine
+
+
+async def check_replica(key, now):
+    replica = replica_engines[key]
+
+    try:
+        async with replica.connect() as connection:
+            lag = (await connection.exec_driver_sql(replicas.lag_query(replica.dialect.name))).scalar()
+    except SQLAlchemyError as e:
+        replicas.replica_set.mark_down(key, repr(e), now)
+        return False
+
+    return replicas.replica_set.checked(key, float(lag or 0), now)
+
+
+async def choose_replica(tables):
+    if len(replica_engines) == 0 or not replicas.may_use_replica(tables):
+        return None
+
+    now = time.monotonic()
+
+    for key in replicas.replica_set.candidates(now):
+        if not replicas.replica_set.needs_check(key, now) or await check_replica(key, now):
+            return key
+
+    return None
+
+
+async def read(tables, run):
+    """Await run(connection) on a replica when one may serve reads of
+    tables (see flaskr.replicas), falling back to the primary."""
+    key = await choose_replica(tables)
+
+    if key != None:
+        try:
+            async with replica_engines[key].connect() as connection:
+                return await run(connection)
+        except CONNECTION_ERRORS as e:
+            replicas.replica_set.mark_down(key, repr(e))
+
+    async with engine.connect() as connection:
+        return await run(connection)
+
+
+async def fetch_rows(connection, statement):
+    result = await connection.execute(statement)
+    keys = tuple(result.keys())
+
+    return [dict(zip(keys, row)) for row in result]
+
+
+async def dispose_engines():
+    for each in [engine, *replica_engines.values()]:
+        if each != None:
+            await each.dispose()
+
+
+async def get_user_by_username(username):
+    # Only login uses it, which reads from the primary like the WSGI login
+    async with engine.connect() as connection:
+        result = await connection.execute(shared.user_by_username_statement(username))
+        return result.first()
+
+
+async def get_session_by_token(token):
+    session = session_cache.get(token)
+
+    if session == None:
+        async with engine.connect() as connection:
+            result = await connection.execute(shared.session_by_token_statement(token))
+            row = result.first()
+
+        if row == None:
+            return None
+
+        session = shared.serialize_session(row)
+        session_cache.put(token, session)
+
+    now = dt.datetime.now()
+
+    if not shared.check_session(token, session, now):
+        return None
+
+    if session_expiry.needs_touch(session, now):
+        async with engine.begin() as connection:
+            await connection.execute(shared.touch_session_statement(session, now))
+
+        shared.session_touched(session, now)
+
+    return session
+
+
+async def insert_session_for_user(user_id, session_data):
+    values = shared.session_values(user_id, session_data)
+    session_id = await try_insert_session(values)
+
+    if session_id != None:
+        return session_id
+
+    # Make room if the existing session has expired but not been swept yet
+    conditions = shared.expired_session_of_user_filter(user_id, values['created_at'])
+
+    if conditions == None or len(await delete_sessions_where(*conditions)) == 0:
+        return None
+
+    return await try_insert_session(values)
+
+
+async def try_insert_session(values):
+    statement, upsert = shared.insert_session_statement(engine.dialect, values)
+
+    try:
+        async with engine.begin() as connection:
+            result = await connection.execute(statement)
+            session_id = result.scalar() if upsert else result.inserted_primary_key[0]
+    except IntegrityError:
+        return None
+
+    if session_id != None:
+        shared.session_created(values['user_id'])
+
+    return session_id
+
+
+async def delete_sessions_where(*conditions):
+    """Delete the matching sessions in one transaction. Returns the ids of
+    their users, after the bookkeeping."""
+    returning, *rest = shared.delete_sessions_statements(engine.dialect, *conditions)
+
+    async with engine.begin() as connection:
+        user_ids = (await connection.execute(returning)).scalars().all()
+
+        for statement in rest:
+            await connection.execute(statement)
+
+    shared.sessions_deleted(user_ids)
+
+    return user_ids
+
+
+async def delete_expired_sessions(column, cutoff, limit):
+    return len(await delete_sessions_where(*shared.oldest_sessions_filter(column, cutoff, limit)))
+
+
+async def delete_session(token):
+    session_cache.invalidate(token)
+
+    await delete_sessions_where(Session.token == token)
+
+
+async def delete_session_by_id(id):
+    await delete_sessions_where(Session.id == id)
+
+
+async def insert_user(user_data):
+    async with engine.begin() as connection:
+        await connection.execute(shared.insert_user_statement(user_data))
+
+    shared.users_inserted([user_data.get('username')])
+
+
+async def insert_users(users):
+    rows = shared.user_rows(users)
+    statement = shared.insert_users_statement(engine.dialect, rows)
+
+    async with engine.begin() as connection:
+        if statement != None:
+            inserted = (await connection.execute(statement)).scalars().all()
+        else:
+            inserted = []
+            for row in rows:
+                try:
+                    async with connection.begin_nested():
+                        await connection.execute(insert(User.__table__), row)
+                    inserted.append(row.get('username'))
+                except IntegrityError:
+                    pass
+
+    shared.users_inserted(inserted)
+
+    return inserted
+
+
+async def delete_users(ids):
+    ids = shared.deleting_users(ids)
+    delete_sessions, delete_users = shared.delete_users_statements(ids)
+
+    async with engine.begin() as connection:
+        await connection.execute(delete_sessions)
+        result = await connection.execute(delete_users)
+
+    shared.users_deleted(ids)
+
+    return result.rowcount
+
+
+async def modify_users(users_data):
+    """Apply per-user patches with one executemany UPDATE per set of patched
+    columns."""
+    updates = shared.user_patch_updates(users_data)
+
+    if len(updates) == 0:
+        return
+
+    async with engine.begin() as connection:
+        for statement, rows in updates:
+            await connection.execute(statement, rows)
+
+    shared.users_modified()
+
+
+async def list_users(after_id=None, limit=None, fields=None):
+    statement = shared.list_users_statement(after_id, limit, fields)
+
+    return await read(('user',), lambda connection: fetch_rows(connection, statement))
+
+
+async def list_sessions(fields=None):
+    statement = shared.list_sessions_statement(fields)
+
+    # created_at stays a datetime; the response encoder formats it
+    return await read(('session', 'user'), lambda connection: fetch_rows(connection, statement))
+
+
+async def online_user_ids():
+    async with engine.connect() as connection:
+        return (await connection.execute(shared.online_user_ids_statement())).scalars().all()
+
+
+async def count_online_users():
+    statement = shared.count_online_users_statement()
+
+    return await read(('session',), lambda connection: connection.scalar(statement))
+
+
+async def is_user_online(user_id):
+    statement = shared.is_user_online_statement(user_id)
+
+    return await read(('session',), lambda connection: connection.scalar(statement)) != None
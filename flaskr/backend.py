@@ -1,16 +1,30 @@
 from flask import Flask, request
 from flask_restful import Resource, Api, abort
-from flaskr.schemas import LoginFormSchema, SessionDataSchema, UserDataSchema, UserDeletionSchema, UserModificationSchema, TokenDataSchema, NewUserDataSchema
+from werkzeug.exceptions import TooManyRequests
+from flaskr.schemas import FieldSelectionSchema, ListPageSchema, LoginFormSchema, UserDataSchema, UserDeletionSchema, UserModificationSchema, TokenDataSchema, NewUserDataSchema, UserPatchSchema, UserBulkDeletionSchema, UserBulkModificationSchema
 import flaskr.database as database
+import flaskr.hashing as hashing
+import flaskr.presence as presence
+import flaskr.querybudget as querybudget
+import flaskr.ratelimit as ratelimit
+import flaskr.replicas as replicas
+import flaskr.tokens as tokens
 import logging
 import sqlalchemy
 import psycopg2
-import hashlib
+import base64
+import math
 import datetime as dt
 import re
 import secrets
 
 
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_PAGE_SIZE = 100
+BULK_BATCH_SIZE = 1000
+
 def use_schema(schema, need_plaintext_password=False):
     def decorator(func):
         def wrapper(*args):
@@ -18,19 +32,19 @@ def use_schema(schema, need_plaintext_password=False):
 
             data = args[0]
 
-            logging.info(f'Using schema {schema.__name__} on data {str(data)}')
+            logger.debug('Using schema %s', schema.__name__)
 
             abort_if_cant_validate(data=data, schema=schema)
 
             if need_plaintext_password == False:
                 data = hide_plaintext_password(data=data)
-                logging.info(f'Hided the plaintext password in data: {data}')
+                logger.debug('Hided the plaintext password in data')
 
 
             data = schema.serialize(data)
 
-            logging.info('Finished validating & cleaning data!')
-            logging.info(f'Calling {str(func.__name__)} with {data}')
+            logger.debug('Finished validating & cleaning data!')
+            logger.debug('Calling %s with %s', func.__name__, data)
 
             return func(data)
         return wrapper
@@ -56,120 +70,192 @@ def session_exists(token):
 
 
 def abort_if_cant_login_with_credentials(username, password):
-    logging.info(f'Trying to authenticate with username={username} and password={password}...')
+    logger.debug('Trying to authenticate with username=%s...', username)
 
-    if user_exists(username=username) == False:
+    user = database.get_user_by_username(username=username)
+
+    if user == None:
         abort(401, message='Wrong username')
-    
-    result = database.get_user_by_credentials(username=username, password=password)
 
-    if result == None:
-        abort(401, message=f'Wrong credentials: {username} | {password}')
-    
-    logging.info('Authentication successful!')
+    try:
+        verified = hashing.verify_password(password, user.password, username)
+    except hashing.PoolSaturated:
+        abort(503, message=HASHING_BUSY_MESSAGE)
+
+    if verified == False:
+        abort(401, message=f'Wrong credentials: {username}')
+
+    logger.debug('Authentication successful!')
+
+    return user
 
 
 def abort_if_cant_login_with_token(token):
-    logging.info(f'Trying to authenticate with token={token}...')
+    """Return the session the token belongs to. Signed tokens are checked
+    without touching the database."""
+    logger.debug('Trying to authenticate with token=%s...', token)
+
+    if tokens.enabled():
+        session = tokens.verify(token)
+    else:
+        session = database.get_session_by_token(token=token)
 
-    if session_exists(token=token) == False:
+    if session == None:
         abort(401, message=f'Invalid token: {token}')
-    
-    logging.info('Authentication successful!')
+
+    logger.debug('Authentication successful!')
+
+    return session
+
+
+def end_session(token, session):
+    if tokens.enabled():
+        # Revoked first, so the token is dead even if the delete fails
+        tokens.revoke_session(session)
+        database.delete_session_by_id(session.get('id'))
+    else:
+        database.delete_session(token)
+
+
+def revoke_users(ids):
+    if tokens.enabled():
+        for id in ids:
+            tokens.revoke_user(id)
+
+
+def abort_if_rate_limited(ip, username):
+    """Reject a login attempt over its IP or username allowance. Runs on the
+    raw form, before validation or any database work."""
+    retry_after = ratelimit.check_login(ip=ip, username=username)
+
+    if retry_after == None:
+        return
+
+    logger.warning('Rate limited login from %s for %s', ip, username)
+
+    error = TooManyRequests(retry_after=math.ceil(retry_after))
+    error.data = {'message': 'Too many login attempts, try again later.'}
+    raise error
 
 
 def abort_if_cant_validate(data, schema):
-    logging.info(f'Trying to validate {data} with {schema.__name__}...')
+    logger.debug('Trying to validate with %s...', schema.__name__)
+
+    # E.g. a JSON array posted to a route that takes an object
+    if not isinstance(data, dict):
+        abort(400, message='Expected a JSON object')
 
     validation_result = schema.validate(data)
 
     if validation_result != None:
-        abort(404, message=str(validation_result))
+        abort(400, message=validation_result)
     
-    logging.info('Valid!')
+    logger.debug('Valid!')
+
+
+WEAK_PASSWORD_MESSAGE = 'Password is too weak (At least 8 characters, [a-zA-Z0-9])'
+
+
+def password_is_complex(password):
+    return re.match(r"^[a-zA-Z0-9]{8,}$", password) != None
 
 
 def abort_if_password_isnt_complex(password):
-    if re.match(r"^[a-zA-Z0-9]{8,}$", password):
+    if password_is_complex(password):
         return True
-    
-    abort(401, message='Password is too weak (At least 8 characters, [a-zA-Z0-9])')
-
 
-def get_salted_password(password, unqiue_salt_source):
-    part1 = str.encode(password)
-    part2 = str.encode(hashlib.sha256(str.encode(unqiue_salt_source)).hexdigest())
-    return part1 + part2
+    abort(401, message=WEAK_PASSWORD_MESSAGE)
 
 
-def get_salted_hash(password, unqiue_salt_source):
-    return hashlib.sha256(get_salted_password(password=password, unqiue_salt_source=unqiue_salt_source)).hexdigest()
+HASHING_BUSY_MESSAGE = 'Too many password hashes in progress, try again later'
 
 
 def hide_plaintext_password(data):
     if data.get('password') is None or data.get('username') is None:
         return data
-    
-    data.update(
-        password=get_salted_hash(
-            password=data.get('password'),
-            unqiue_salt_source=data.get('username')
-        )
-    )
+
+    try:
+        password = hashing.hash_password(data.get('password'), data.get('username'))
+    except hashing.PoolSaturated:
+        abort(503, message=HASHING_BUSY_MESSAGE)
+
+    data.update(password=password)
 
     return data
 
 
+def rehash_if_needed(user, password):
+    # Upgrades legacy or under-cost hashes while the plaintext is at hand
+    if not hashing.needs_rehash(user.password):
+        return
+
+    try:
+        database.modify_user({
+            'id': user.id,
+            'password': hashing.hash_password(password, user.username)
+        })
+    except Exception as e:
+        logger.warning('Couldn\'t rehash the password of user %s: %r', user.id, e)
+
+
 def generate_token():
     return secrets.token_urlsafe(16)
 
 
-@use_schema(LoginFormSchema)
+@use_schema(LoginFormSchema, need_plaintext_password=True)
 def login(login_form):
-    abort_if_cant_login_with_credentials(
-        username=login_form.get('username'),
-        password=login_form.get('password')
-    )
+    # A salted KDF can't be compared in SQL, so the hash is checked here.
+    # Read from the primary, since accounts often log in right after signup.
+    with replicas.on_primary():
+        user = abort_if_cant_login_with_credentials(
+            username=login_form.get('username'),
+            password=login_form.get('password')
+        )
 
-    user = database.get_user_by_credentials(
-        username=login_form.get('username'),
-        password=login_form.get('password')
-    )
+    rehash_if_needed(user=user, password=login_form.get('password'))
 
-    if user == None:
-        return abort(500, message='No such user.')
+    session_data = new_session_data(ip=login_form.get('ip'))
+
+    try:
+        session_id = database.insert_session_for_user(
+            user_id=user.id,
+            session_data=session_data
+        )
+    except Exception as e:
+        abort(500, message=repr(e))
 
-    if database.get_session_by_credentials(
-        username=login_form.get('username'),
-        password=login_form.get('password')
-    ) != None:
-        return abort(500, message='The user is already logged in.')
+    return login_token(user.id, session_id, session_data)
 
-    session_data = SessionDataSchema.serialize({
+
+def new_session_data(ip):
+    return {
         'created_at': dt.datetime.now().isoformat(),
-        'ip': login_form.get('ip'),
-        'user_id': user.id,
+        'ip': ip,
         'token': generate_token()
-    })
+    }
 
-    try:
-        database.insert_session(session_data)
-    except Exception as e:
-        abort(500, message=repr(e))
-    
-    logging.debug(session_data)
+
+def login_token(user_id, session_id, session_data):
+    """The token to hand out for a session insert's result."""
+    if session_id == None:
+        abort(500, message='The user is already logged in.')
+
+    logger.debug('Created session %s', session_data)
+
+    if tokens.enabled():
+        return tokens.issue(user_id, session_id)
 
     return session_data.get('token')
 
 
 @use_schema(TokenDataSchema)
 def logout(token_data):
-    abort_if_cant_login_with_token(
+    session = abort_if_cant_login_with_token(
         token=token_data.get('token')
     )
 
     try:
-        database.delete_session(token_data.get('token'))
+        end_session(token_data.get('token'), session)
     except Exception as e:
         abort(500, message=repr(e))
 
@@ -186,23 +272,126 @@ def create_user(user):
         abort(500, message=repr(e))
 
 
+def check_bulk_user(user):
+    """Return why a bulk import row is rejected, or None."""
+    if not isinstance(user, dict):
+        return 'Each row must be a JSON object'
+
+    validation_result = NewUserDataSchema.validate(user)
+
+    if validation_result != None:
+        return validation_result
+
+    if not password_is_complex(user.get('password')):
+        return WEAK_PASSWORD_MESSAGE
+
+    return None
+
+
+def hash_bulk_passwords(batch):
+    passwords = hashing.hash_passwords(
+        [user.get('password') for _, user in batch],
+        [user.get('username') for _, user in batch]
+    )
+
+    for (_, user), password in zip(batch, passwords):
+        user.update(password=password)
+
+
+def count_inserted(batch, inserted, failed):
+    # Usernames may repeat inside a batch; only one of them got in
+    created = 0
+    remaining = set(inserted)
+
+    for index, user in batch:
+        if user.get('username') in remaining:
+            remaining.remove(user.get('username'))
+            created += 1
+        else:
+            failed.append({'index': index, 'message': 'A user with this username, email or id already exists'})
+
+    return created
+
+
+def create_users(users):
+    """Validate and insert many users, committing once per batch.
+
+    Rows get the same checks as create_user, but a bad row is reported in
+    the result instead of aborting the whole import.
+    """
+    created = 0
+    failed = []
+
+    for batch in bulk_batches(users, failed):
+        querybudget.allow(1)
+
+        try:
+            hash_bulk_passwords(batch)
+            inserted = database.insert_users([user for _, user in batch])
+        except Exception as e:
+            fail_batch(batch, e, failed)
+            continue
+
+        created += count_inserted(batch, inserted, failed)
+
+    return bulk_result(created, failed)
+
+
+def bulk_batches(users, failed):
+    """Yield the valid rows as (index, user) batches of BULK_BATCH_SIZE,
+    reading users lazily so a streamed import never sits in memory whole.
+    Rejected rows are added to failed."""
+    batch = []
+
+    for index, user in enumerate(users):
+        error = check_bulk_user(user)
+
+        if error != None:
+            failed.append({'index': index, 'message': error})
+            continue
+
+        batch.append((index, NewUserDataSchema.serialize(user)))
+
+        if len(batch) >= BULK_BATCH_SIZE:
+            yield batch
+            batch = []
+
+    if len(batch) > 0:
+        yield batch
+
+
+def fail_batch(batch, error, failed):
+    message = HASHING_BUSY_MESSAGE if isinstance(error, hashing.PoolSaturated) else repr(error)
+    failed.extend({'index': index, 'message': message} for index, _ in batch)
+
+
+def bulk_result(created, failed):
+    logger.info('Bulk import: %d created, %d failed', created, len(failed))
+
+    return {
+        'created': created,
+        'failed': failed
+    }
+
+
 @use_schema(UserDeletionSchema)
 def delete_user(user_deletion):
-    abort_if_cant_login_with_token(
+    session = abort_if_cant_login_with_token(
         token=user_deletion.get('token')
     )
 
     try:
         try:
-            database.delete_session(token=user_deletion.get('token'))
+            end_session(user_deletion.get('token'), session)
         except Exception:
             pass
-        
-        session = database.get_session_by_token(user_deletion.get('token'))
+
         database.delete_user(user_deletion.get('id'))
     except Exception as e:
         abort(500, message=repr(e))
 
+    revoke_users([user_deletion.get('id')])
+
 
 @use_schema(UserModificationSchema)
 def modify_user(user_modification):
@@ -216,19 +405,155 @@ def modify_user(user_modification):
         abort(500, message=repr(e))
 
 
-def list_users():
+@use_schema(UserBulkDeletionSchema)
+def delete_users(user_deletion):
+    abort_if_cant_login_with_token(
+        token=user_deletion.get('token')
+    )
+
     try:
-        result = database.list_users()
+        deleted = database.delete_users(user_deletion.get('ids'))
     except Exception as e:
         abort(500, message=repr(e))
 
-    return result
+    revoke_users(user_deletion.get('ids'))
+
+    return {
+        'deleted': deleted
+    }
+
+
+@use_schema(UserBulkModificationSchema)
+def modify_users(user_modification):
+    abort_if_cant_login_with_token(
+        token=user_modification.get('token')
+    )
+
+    try:
+        database.modify_users([UserPatchSchema.serialize(x) for x in user_modification.get('users')])
+    except Exception as e:
+        abort(500, message=repr(e))
+
+
+def encode_cursor(id):
+    return base64.urlsafe_b64encode(str(id).encode()).decode().rstrip('=')
+
 
+def decode_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
 
-def list_onlineusers():
     try:
-        result = database.list_sessions()
+        return int(base64.urlsafe_b64decode(padded).decode())
+    except ValueError:
+        abort(400, message=f'Invalid cursor: {cursor}')
+
+
+def parse_fields(fields, available):
+    """Split a ?fields= list and check every name against the model's
+    columns. Returns None when all fields are wanted."""
+    if fields == None:
+        return None
+
+    names = list(dict.fromkeys(fields.split(',')))
+    unknown = [name for name in names if name not in available]
+
+    if len(unknown) > 0:
+        abort(400, message=f'Unknown fields: {", ".join(unknown)}')
+
+    return names
+
+
+def with_cursor_field(fields):
+    # The cursor is built from the id, so it's selected even if not requested
+    if fields == None or 'id' in fields:
+        return fields
+
+    return ['id'] + fields
+
+
+def drop_cursor_field(users, fields):
+    if fields == None or 'id' in fields:
+        return users
+
+    return [{k: v for k, v in user.items() if k != 'id'} for user in users]
+
+
+def page_query(page):
+    """Returns the limit, fields and after_id of a validated page request."""
+    # Validated, but still the query argument's string
+    limit = int(page['limit']) if page.get('limit') != None else DEFAULT_PAGE_SIZE
+    fields = parse_fields(page.get('fields'), database.USER_FIELDS)
+
+    after_id = None
+    if page.get('cursor') != None:
+        after_id = decode_cursor(page.get('cursor'))
+
+    return limit, fields, after_id
+
+
+def users_page(users, limit, fields):
+    # The query fetched one extra row to learn whether another page exists
+    next_cursor = None
+    if len(users) > limit:
+        users = users[:limit]
+        next_cursor = encode_cursor(users[-1].get('id'))
+
+    users = drop_cursor_field(users, fields)
+
+    return {
+        'users': users,
+        'next_cursor': next_cursor
+    }
+
+
+@use_schema(ListPageSchema)
+def list_users(page):
+    limit, fields, after_id = page_query(page)
+
+    try:
+        users = database.list_users(after_id=after_id, limit=limit + 1, fields=with_cursor_field(fields))
+    except Exception as e:
+        abort(500, message=repr(e))
+
+    return users_page(users, limit, fields)
+
+
+@use_schema(FieldSelectionSchema)
+def list_onlineusers(selection):
+    fields = parse_fields(selection.get('fields'), database.SESSION_FIELDS)
+
+    try:
+        result = database.list_sessions(fields=fields)
     except Exception as e:
         abort(500, message=repr(e))
     
     return result
+
+
+def count_onlineusers():
+    count = presence.count()
+
+    if count == None:
+        try:
+            count = database.count_online_users()
+        except Exception as e:
+            abort(500, message=repr(e))
+
+    return {
+        'count': count
+    }
+
+
+def get_onlineuser(id):
+    online = presence.is_online(id)
+
+    if online == None:
+        try:
+            online = database.is_user_online(id)
+        except Exception as e:
+            abort(500, message=repr(e))
+
+    return {
+        'id': id,
+        'online': online
+    }
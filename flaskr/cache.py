@@ -0,0 +1,67 @@
+from collections import OrderedDict
+import threading
+import time
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache():
+    """Bounded in-process LRU cache whose entries also expire after a TTL.
+
+    Each uWSGI worker holds its own instance, so the TTL bounds how long a
+    worker can keep serving an entry that another worker invalidated.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, max_size, ttl):
+        with self._lock:
+            self.max_size = max_size
+            self.ttl = ttl
+            self._evict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry != None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                return entry[1]
+
+            if entry != None:
+                del self._entries[key]
+
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate_if(self, predicate):
+        with self._lock:
+            stale = [k for k, (_, v) in self._entries.items() if predicate(v)]
+
+            for key in stale:
+                del self._entries[key]
+
+        logger.debug('Invalidated %d cache entries', len(stale))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _evict(self):
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
@@ -1,18 +1,120 @@
 from flask import jsonify
-from flaskr.schemas import UserDataSchema, SessionDataSchema, NewUserDataSchema
+from flaskr.cache import TTLCache
+from flaskr.replicas import CONNECTION_ERRORS, RoutingSession
+import flaskr.presence as presence
+import flaskr.querybudget as querybudget
+import flaskr.replicas as replicas
+import flaskr.versions as versions
 from dataclasses import dataclass
 import datetime as dt
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import ForeignKey, TIMESTAMP
+from sqlalchemy import ForeignKey, TIMESTAMP, bindparam, delete, insert, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.sql import text
 import logging
+import collections
 import datetime as dt
+import functools
+import io
 
-logging.info('Creating db instance...')
 
-db = SQLAlchemy()
+logger = logging.getLogger(__name__)
+
+logger.info('Creating db instance...')
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+logger.info('Finished creating db instance!')
+
+# Token -> serialized session. Sized and timed from the app config in
+# flaskr/__init__.py; the short TTL bounds staleness across uWSGI workers.
+session_cache = TTLCache(max_size=10000, ttl=5)
+
+
+class SessionExpiry():
+    """Session lifetime limits in seconds; None disables a limit.
+
+    last_seen_at is only written once touch_interval has passed, so an
+    authenticated request costs no extra write most of the time. Keep the
+    interval well below the idle timeout.
+    """
+
+    def __init__(self, ttl=None, idle_timeout=None, touch_interval=60):
+        self.configure(ttl, idle_timeout, touch_interval)
+
+    def configure(self, ttl, idle_timeout, touch_interval):
+        self.ttl = ttl
+        self.idle_timeout = idle_timeout
+        self.touch_interval = touch_interval
+
+    def created_cutoff(self, now):
+        if self.ttl == None:
+            return None
+
+        return now - dt.timedelta(seconds=self.ttl)
+
+    def seen_cutoff(self, now):
+        if self.idle_timeout == None:
+            return None
+
+        return now - dt.timedelta(seconds=self.idle_timeout)
+
+    def is_expired(self, session, now):
+        created_cutoff = self.created_cutoff(now)
+        seen_cutoff = self.seen_cutoff(now)
+
+        if created_cutoff != None and dt.datetime.fromisoformat(session.get('created_at')) < created_cutoff:
+            return True
+
+        last_seen_at = session.get('last_seen_at') or session.get('created_at')
+
+        return seen_cutoff != None and dt.datetime.fromisoformat(last_seen_at) < seen_cutoff
+
+    def needs_touch(self, session, now):
+        if self.idle_timeout == None:
+            return False
+
+        last_seen_at = session.get('last_seen_at') or session.get('created_at')
+
+        return dt.datetime.fromisoformat(last_seen_at) < now - dt.timedelta(seconds=self.touch_interval)
+
+
+# Configured from the app config in flaskr/__init__.py
+session_expiry = SessionExpiry()
+
+
+def read_from_replica(*tables):
+    """Run the decorated read on a replica when one may serve reads of
+    tables (see flaskr.replicas), falling back to the primary."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = None
+
+            if not db.session.info.get('wrote'):
+                key = replicas.choose(tables, db.engines)
+
+            if key == None:
+                return func(*args, **kwargs)
+
+            token = replicas.current_replica.set(key)
+            issued = querybudget.issued()
+
+            try:
+                return func(*args, **kwargs)
+            except CONNECTION_ERRORS as e:
+                db.session.rollback()
+                replicas.replica_set.mark_down(key, repr(e))
+                # The retry on the primary repeats what failed on the replica
+                querybudget.allow(querybudget.issued() - issued)
+            finally:
+                replicas.current_replica.reset(token)
+
+            return func(*args, **kwargs)
+        return wrapper
+    return decorator
 
-logging.info('Finished creating db instance!')
 
 @dataclass
 class User(db.Model):
@@ -55,6 +157,7 @@ class Session(db.Model):
     ip: str
     user_id: int
     token: str
+    last_seen_at: dt.datetime
 
     # https://stackoverflow.com/a/18854791
 
@@ -63,154 +166,614 @@ class Session(db.Model):
     ip = db.Column(db.String(255))
     user_id = db.Column(db.Integer, ForeignKey(User.id), unique=True)
     token = db.Column(db.String(255))
+    last_seen_at = db.Column(TIMESTAMP)
+
+    __table_args__ = (
+        db.Index('ix_session_token', 'token', unique=True),
+        db.Index('ix_session_created_at', 'created_at'),
+        db.Index('ix_session_last_seen_at', 'last_seen_at'),
+    )
 
 
     def serialize(self):
        """Return object data in easily serializable format"""
-       logging.info(f'Serializing {type(self).__name__} object: {self.__dict__}')
+       return serialize_session(self)
 
-       return {
-            'id': self.id,
-            'created_at': self.created_at.isoformat(),
-            'ip': self.ip,
-            'user_id': self.user_id,
-            'token': self.token
-       }
-    
-    def join_and_serialize(self):
-        logging.info(f'Joining {type(self).__name__} with {User.__name__} using {self.user_id}')
-        result = get_user_by_id(self.user_id)
-
-        if result == None:
-            return None
-        else:
-            user = result.serialize()
 
-            return self.serialize() | {
-                'username': user.get('username')
-            }
+def serialize_session(row):
+    # Takes a Session or a row of its table
+    return {
+        'id': row.id,
+        'created_at': row.created_at.isoformat(),
+        'ip': row.ip,
+        'user_id': row.user_id,
+        'token': row.token,
+        'last_seen_at': row.last_seen_at.isoformat() if row.last_seen_at != None else None
+    }
 
 
 def delete_empty_fields(data):
     return {k: v for k, v in data.items() if v}
 
 
-def get_user_by_credentials(username, password):
-    logging.info(f'Database select user with username={username}, password={password}...')
-    result = User.query.filter_by(username=username, password=password).first()
-    logging.info(f'Result: {str(result)}')
+@read_from_replica('user')
+def get_user_by_id(id):
+    logger.debug('Database select user with id=%s', id)
+    result = User.query.filter_by(id=id).first()
+    logger.debug('Result: %s', result)
 
     return result
 
 
-def get_user_by_id(id):
-    logging.info(f'Database select user with id={id}')
-    result = User.query.filter_by(id=id).first()
-    logging.info(f'Result: {str(result)}')
+# The statement builders and bookkeeping below are shared with
+# flaskr.async_database, so both serving modes run the same SQL and keep the
+# caches, table versions and presence registry in step.
 
-    return result
+
+def user_by_username_statement(username):
+    return select(User.__table__).where(User.username == username)
 
 
+@read_from_replica('user')
 def get_user_by_username(username):
-    return User.query.filter_by(username=username).first()
+    return db.session.execute(user_by_username_statement(username)).first()
 
 
-def get_session_by_credentials(username, password):
-    user = get_user_by_credentials(
-        username=username,
-        password=password
-    )
+def session_by_token_statement(token):
+    return select(Session.__table__).where(Session.token == token)
+
+
+def touch_session_statement(session, now):
+    return update(Session.__table__).\
+        where(Session.id == session.get('id')).\
+        values(last_seen_at=now)
+
+
+def check_session(token, session, now):
+    """Return whether a looked up session is still live. Expired rows are
+    left for the sweeper to delete."""
+    if session_expiry.is_expired(session, now):
+        session_cache.invalidate(token)
+        return False
+
+    return True
+
 
-    return Session.query.filter_by(user_id=user.id).first()
+def session_touched(session, now):
+    # Updates the cached copy too
+    session['last_seen_at'] = now.isoformat()
 
 
 def get_session_by_token(token):
-    return Session.query.filter_by(token=token).first()
-
-
-def get_user_model_object_from_schema(user_data):
-    return User(
-        id=user_data.get('id'),
-        username=user_data.get('username'),
-        firstname=user_data.get('firstname'),
-        middlename=user_data.get('middlename'),
-        lastname=user_data.get('lastname'),
-        birthdate=user_data.get('birthdate'),
-        email=user_data.get('email'),
-        password=user_data.get('password')
-    )
+    """Return the live session for token, or None if it doesn't exist or
+    has expired.
 
+    Always read from the primary: a token is typically used right after the
+    login that created it."""
+    result = session_cache.get(token)
 
-def get_session_model_object_from_schema(session_data):
-    return Session(
-        id=session_data.get('id'),
-        created_at=session_data.get('created_at'),
-        ip=session_data.get('ip'),
-        user_id=session_data.get('user_id'),
-        token=session_data.get('token')
-    )
+    if result == None:
+        row = db.session.execute(session_by_token_statement(token)).first()
+
+        if row == None:
+            return None
 
+        result = serialize_session(row)
+        session_cache.put(token, result)
 
-def insert_session(session_data):
-    logging.info(f'Inserting session data to database: {session_data}')
-    session = get_session_model_object_from_schema(session_data=session_data)
+    now = dt.datetime.now()
 
-    db.session.add(session)
+    if not check_session(token, result, now):
+        return None
+
+    if session_expiry.needs_touch(result, now):
+        touch_session(result, now)
+
+    return result
+
+
+def touch_session(session, now):
+    db.session.execute(touch_session_statement(session, now))
     db.session.commit()
+    session_touched(session, now)
+
+
+# Dialects that support INSERT ... ON CONFLICT DO NOTHING ... RETURNING
+UPSERT_DIALECTS = {
+    'postgresql': postgresql.insert,
+    'sqlite': sqlite.insert
+}
+
+
+def insert_session_for_user(user_id, session_data):
+    """Create a session unless the user already has a live one.
+
+    The unique Session.user_id decides concurrent logins. An expired session
+    that the sweeper hasn't removed yet is deleted and the insert retried.
+    Returns the new session's id, or None if the user already has one.
+    """
+    logger.debug('Inserting session for user_id=%s...', user_id)
+
+    values = session_values(user_id, session_data)
+    session_id = try_insert_session(values)
+
+    if session_id != None:
+        return session_id
+
+    if delete_expired_session_of_user(user_id, values['created_at']) == 0:
+        return None
+
+    return try_insert_session(values)
+
+
+def session_values(user_id, session_data):
+    created_at = dt.datetime.fromisoformat(session_data.get('created_at'))
+
+    return {
+        'created_at': created_at,
+        'ip': session_data.get('ip'),
+        'user_id': user_id,
+        'token': session_data.get('token'),
+        'last_seen_at': created_at
+    }
+
+
+def insert_session_statement(dialect, values):
+    """Returns the INSERT and whether it's an upsert that returns the new
+    id, or nothing if the user already has a session. A plain INSERT raises
+    IntegrityError instead."""
+    upsert = UPSERT_DIALECTS.get(dialect.name)
+
+    if upsert != None:
+        return upsert(Session.__table__).\
+            values(values).\
+            on_conflict_do_nothing(index_elements=[Session.user_id]).\
+            returning(Session.id), True
+
+    return insert(Session.__table__).values(values), False
+
+
+def session_created(user_id):
+    versions.bump('session')
+    presence.user_online(user_id)
+
+
+def try_insert_session(values):
+    statement, upsert = insert_session_statement(db.engine.dialect, values)
+
+    try:
+        result = db.session.execute(statement)
+        session_id = result.scalar() if upsert else result.inserted_primary_key[0]
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return None
+
+    if session_id != None:
+        session_created(values['user_id'])
+
+    return session_id
+
+
+def expired_session_filter(now):
+    created_cutoff = session_expiry.created_cutoff(now)
+    seen_cutoff = session_expiry.seen_cutoff(now)
+    conditions = []
+
+    if created_cutoff != None:
+        conditions.append(Session.created_at < created_cutoff)
+    if seen_cutoff != None:
+        conditions.append(Session.last_seen_at < seen_cutoff)
+
+    return conditions
+
+
+def expired_session_of_user_filter(user_id, now):
+    """Conditions matching the user's session if it has expired, or None
+    when sessions never expire."""
+    conditions = expired_session_filter(now)
+
+    if len(conditions) == 0:
+        return None
+
+    return [Session.user_id == user_id, db.or_(*conditions)]
+
+
+def delete_expired_session_of_user(user_id, now):
+    conditions = expired_session_of_user_filter(user_id, now)
+
+    if conditions == None:
+        return 0
+
+    user_ids = delete_sessions_where(*conditions)
+    db.session.commit()
+    sessions_deleted(user_ids)
+
+    return len(user_ids)
+
+
+def oldest_sessions_filter(column, cutoff, limit):
+    oldest = select(Session.id).\
+        where(column < cutoff).\
+        order_by(column).\
+        limit(limit)
+
+    return [Session.id.in_(oldest.scalar_subquery())]
+
+
+def delete_expired_sessions(column, cutoff, limit):
+    """Delete up to limit sessions whose column is older than cutoff, oldest
+    first, in one short transaction. Returns the number deleted."""
+    try:
+        user_ids = delete_sessions_where(*oldest_sessions_filter(column, cutoff, limit))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    sessions_deleted(user_ids)
+
+    return len(user_ids)
+
+
+def delete_sessions_statements(dialect, *conditions):
+    """The statements that delete the matching sessions and yield the ids of
+    their users, which the presence registry needs: a DELETE ... RETURNING,
+    or a SELECT of the ids followed by the DELETE."""
+    statement = delete(Session.__table__).where(*conditions)
+
+    if dialect.delete_returning:
+        return [statement.returning(Session.user_id)]
+
+    return [select(Session.user_id).where(*conditions), statement]
+
+
+def sessions_deleted(user_ids):
+    if len(user_ids) > 0:
+        versions.bump('session')
+        presence.users_offline(user_ids)
+
+
+def delete_sessions_where(*conditions):
+    """Delete the matching sessions without committing. Returns the ids of
+    their users."""
+    returning, *rest = delete_sessions_statements(db.engine.dialect, *conditions)
+    user_ids = db.session.execute(returning).scalars().all()
+
+    for statement in rest:
+        db.session.execute(statement)
+
+    return user_ids
 
 
 def delete_session(token):
-    session = get_session_by_token(
-        token=token
-    )
+    session_cache.invalidate(token)
 
-    db.session.delete(session)
+    user_ids = delete_sessions_where(Session.token == token)
     db.session.commit()
+    sessions_deleted(user_ids)
+
+
+def delete_session_by_id(id):
+    # Signed tokens never go through the cache, so there's nothing to drop
+    user_ids = delete_sessions_where(Session.id == id)
+    db.session.commit()
+    sessions_deleted(user_ids)
+
+
+def insert_user_statement(user_data):
+    # Unset columns are left to their defaults, e.g. the id
+    return insert(User.__table__).values({column: user_data.get(column) for column in USER_COLUMNS if user_data.get(column) != None})
 
 
 def insert_user(user_data):
-    user = get_user_model_object_from_schema(user_data)
+    try:
+        db.session.execute(insert_user_statement(user_data))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    users_inserted([user_data.get('username')])
+
+
+USER_COLUMNS = ['id', 'username', 'firstname', 'middlename', 'lastname', 'birthdate', 'email', 'password']
+
+
+def copy_field(value):
+    # PostgreSQL COPY text format
+    if value == None:
+        return '\\N'
+
+    return str(value).\
+        replace('\\', '\\\\').\
+        replace('\t', '\\t').\
+        replace('\n', '\\n').\
+        replace('\r', '\\r')
+
+
+def copy_users(users):
+    """COPY users into a staging table, then move them over with one
+    INSERT ... ON CONFLICT DO NOTHING so conflicting rows are skipped rather
+    than failing the whole batch."""
+    quote = db.engine.dialect.identifier_preparer.quote
+    table = quote(User.__table__.name)
+    columns = ', '.join(USER_COLUMNS)
+
+    cursor = db.session.connection().connection.cursor()
+
+    cursor.execute(
+        'CREATE TEMP TABLE IF NOT EXISTS user_import ('
+        'id integer, username varchar(255), firstname varchar(255), '
+        'middlename varchar(255), lastname varchar(255), birthdate varchar(255), '
+        'email varchar(255), password varchar(255)'
+        ') ON COMMIT DELETE ROWS'
+    )
+
+    buffer = io.StringIO()
+    for user in users:
+        buffer.write('\t'.join(copy_field(user.get(column)) for column in USER_COLUMNS))
+        buffer.write('\n')
+    buffer.seek(0)
+
+    cursor.copy_expert(f'COPY user_import ({columns}) FROM STDIN', buffer)
+
+    result = db.session.execute(text(
+        f'INSERT INTO {table} ({columns}) '
+        f'SELECT COALESCE(id, nextval(pg_get_serial_sequence(\'{table}\', \'id\'))), '
+        f'{", ".join(USER_COLUMNS[1:])} FROM user_import '
+        'ON CONFLICT DO NOTHING RETURNING username'
+    ))
+
+    return [row.username for row in result]
+
+
+def insert_users(users):
+    """Insert a batch of users in one transaction.
+
+    Rows that conflict with an existing user are skipped. Returns the
+    usernames that were inserted.
+    """
+    logger.debug('Inserting %d users...', len(users))
+
+    rows = user_rows(users)
+    statement = insert_users_statement(db.engine.dialect, rows)
+
+    try:
+        if db.engine.dialect.name == 'postgresql':
+            inserted = copy_users(rows)
+        elif statement != None:
+            inserted = db.session.execute(statement).scalars().all()
+        else:
+            inserted = []
+            for row in rows:
+                try:
+                    with db.session.begin_nested():
+                        db.session.execute(insert(User.__table__), row)
+                    inserted.append(row.get('username'))
+                except IntegrityError:
+                    pass
+
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    users_inserted(inserted)
+
+    return inserted
+
+
+def user_rows(users):
+    return [{column: user.get(column) for column in USER_COLUMNS} for user in users]
+
+
+def insert_users_statement(dialect, rows):
+    """An INSERT of rows that skips conflicting ones and returns the
+    inserted usernames, or None if the dialect has no such upsert; then each
+    row is inserted in its own savepoint."""
+    upsert = UPSERT_DIALECTS.get(dialect.name)
+
+    if upsert == None:
+        return None
+
+    return upsert(User.__table__).\
+        values(rows).\
+        on_conflict_do_nothing().\
+        returning(User.username)
+
+
+def users_inserted(usernames):
+    if len(usernames) > 0:
+        versions.bump('user')
 
-    db.session.add(user)
-    db.session.commit()
+
+def delete_users(ids):
+    """Delete the users and their sessions with two set-based statements in
+    one transaction. Returns the number of deleted users."""
+    ids = deleting_users(ids)
+    delete_sessions, delete_users = delete_users_statements(ids)
+
+    try:
+        db.session.execute(delete_sessions)
+        deleted = db.session.execute(delete_users).rowcount
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    users_deleted(ids)
+
+    return deleted
+
+
+def deleting_users(ids):
+    """Drop the cached sessions of the users about to be deleted. Returns
+    their ids without duplicates."""
+    ids = list(set(ids))
+    id_set = set(ids)
+
+    session_cache.invalidate_if(lambda session: session.get('user_id') in id_set)
+
+    return ids
+
+
+def delete_users_statements(ids):
+    return [
+        delete(Session.__table__).where(Session.user_id.in_(ids)),
+        delete(User.__table__).where(User.id.in_(ids))
+    ]
+
+
+def users_deleted(ids):
+    versions.bump('user', 'session')
+    presence.users_offline(ids)
 
 
 def delete_user(id):
-    user = get_user_by_id(id)
+    return delete_users([id])
 
-    db.session.delete(user)
-    db.session.commit()
+
+def user_patch_updates(users_data):
+    """Group per-user patches by the columns they set. Returns one Core
+    UPDATE keyed on id per group, with its executemany rows; ids that match
+    no row are skipped, as a single UPDATE would skip them."""
+    groups = collections.defaultdict(list)
+
+    for user_data in users_data:
+        patch = delete_empty_fields(user_data)
+        columns = tuple(sorted(k for k in patch if k != 'id'))
+
+        if len(columns) > 0:
+            groups[columns].append({f'b_{k}': v for k, v in patch.items()})
+
+    return [
+        (
+            update(User.__table__).
+            where(User.id == bindparam('b_id')).
+            values({column: bindparam(f'b_{column}') for column in columns}),
+            rows
+        )
+        for columns, rows in groups.items()
+    ]
+
+
+def modify_users(users_data):
+    """Apply per-user patches with one executemany UPDATE per set of patched
+    columns."""
+    updates = user_patch_updates(users_data)
+
+    if len(updates) == 0:
+        return
+
+    try:
+        for statement, rows in updates:
+            db.session.execute(statement, rows)
+
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    users_modified()
+
+
+def users_modified():
+    versions.bump('user')
 
 
 def modify_user(user_data):
-    user = get_user_by_id(user_data.get('id'))
+    modify_users([user_data])
 
-    user_data = delete_empty_fields(user_data)
 
-    db.session.query(User).\
-        filter(User.id == user_data.get('id')).\
-        update(user_data)
+def fetch_rows(statement):
+    # Executing on the session's connection skips ORM result processing
+    # entirely; rows are zipped straight into dicts for the JSON encoder.
+    result = db.session.connection().execute(statement)
+    keys = tuple(result.keys())
 
-    db.session.commit()
+    return [dict(zip(keys, row)) for row in result]
 
 
-def list_users():
-    users = User.query.all()
-    return [x.serialize() for x in users]
+# Columns the list endpoints can project with ?fields=
+USER_FIELDS = {column.name: column for column in User.__table__.columns}
+# last_seen_at is bookkeeping for the idle timeout and isn't listed; touching
+# it doesn't bump the session version
+SESSION_FIELDS = {column.name: column for column in Session.__table__.columns if column.name != 'last_seen_at'} | {'username': User.username}
 
 
-def list_sessions():
-    sessions = Session.query.\
-        all()
-    
-    result = [x.join_and_serialize() for x in sessions]
+def project(available, fields):
+    if fields == None:
+        return list(available.values())
 
-    
-    if result != None and None in result:
-        logging.info('Removing nulls from result...')
-        result.remove(None)
+    return [available[name] for name in fields]
 
-    return result
+
+def list_users_statement(after_id=None, limit=None, fields=None):
+    # Keyset pagination: seek past the last seen id instead of using OFFSET,
+    # so deep pages cost the same as the first one.
+    statement = select(*project(USER_FIELDS, fields)).\
+        order_by(User.id).\
+        limit(limit)
+
+    if after_id != None:
+        statement = statement.where(User.id > after_id)
+
+    return statement
+
+
+@read_from_replica('user')
+def list_users(after_id=None, limit=None, fields=None):
+    return fetch_rows(list_users_statement(after_id, limit, fields))
+
+
+def list_sessions_statement(fields=None):
+    # Session ⋈ User in a single round trip; the inner join drops sessions
+    # whose user no longer exists.
+    return select(*project(SESSION_FIELDS, fields)).\
+        select_from(Session).\
+        join(User, Session.user_id == User.id).\
+        where(*live_session_filter())
+
+
+@read_from_replica('session', 'user')
+def list_sessions(fields=None):
+    # created_at stays a datetime; the response encoder formats it
+    return fetch_rows(list_sessions_statement(fields))
+
+
+def live_session_filter():
+    expired = expired_session_filter(dt.datetime.now())
+
+    return [db.not_(db.or_(*expired))] if len(expired) > 0 else []
+
+
+def online_user_ids_statement():
+    return select(Session.user_id).where(Session.user_id != None, *live_session_filter())
+
+
+def online_user_ids():
+    """Ids of the users with a live session, read from the primary so a
+    presence rebuild misses no committed login."""
+    return db.session.execute(online_user_ids_statement()).scalars().all()
+
+
+def count_online_users_statement():
+    return select(db.func.count()).select_from(Session).where(Session.user_id != None, *live_session_filter())
+
+
+@read_from_replica('session')
+def count_online_users():
+    return db.session.execute(count_online_users_statement()).scalar()
+
+
+def is_user_online_statement(user_id):
+    return select(Session.id).where(Session.user_id == user_id, *live_session_filter()).limit(1)
+
+
+@read_from_replica('session')
+def is_user_online(user_id):
+    return db.session.execute(is_user_online_statement(user_id)).first() != None
 
 
 def select_user_with_username(username):
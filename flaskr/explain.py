@@ -0,0 +1,117 @@
+from flaskr.database import Session, User
+from sqlalchemy import select
+from sqlalchemy.sql import visitors
+import flaskr.database as database
+import datetime as dt
+
+
+EXPLAIN_PREFIXES = {
+    'postgresql': 'EXPLAIN ',
+    'sqlite': 'EXPLAIN QUERY PLAN '
+}
+
+NOW = dt.datetime(2000, 1, 1)
+
+
+def insert_session_statements(dialect):
+    values = database.session_values(1, {'created_at': NOW.isoformat(), 'ip': '127.0.0.1', 'token': 'token'})
+    statements = [database.insert_session_statement(dialect, values)[0]]
+    expired = database.expired_session_of_user_filter(1, NOW)
+
+    if expired != None:
+        statements += database.delete_sessions_statements(dialect, *expired)
+
+    return statements
+
+
+def bind_values(statement, values):
+    """A copy of an executemany statement with its bind parameters set to
+    one row's values, so it can be rendered with literal binds."""
+    def bind(parameter):
+        if parameter.key in values:
+            parameter.value = values[parameter.key]
+            parameter.required = False
+
+    return visitors.cloned_traverse(statement, {}, {'bindparam': bind})
+
+
+def modify_users_statements(dialect):
+    return [
+        bind_values(statement, rows[0])
+        for statement, rows in database.user_patch_updates([{'id': 1, 'firstname': 'name'}])
+    ]
+
+
+# The statements of each query function, built by the same builders and
+# with representative arguments. Functions listed in FULL_SCANS_ALLOWED are
+# expected to read a whole table.
+QUERIES = [
+    ('get_user_by_id', lambda dialect: [select(User.__table__).where(User.id == 1)]),
+    ('get_user_by_username', lambda dialect: [database.user_by_username_statement('name')]),
+    ('get_session_by_token', lambda dialect: [
+        database.session_by_token_statement('token'),
+        database.touch_session_statement({'id': 1}, NOW)
+    ]),
+    ('insert_session_for_user', insert_session_statements),
+    ('delete_session', lambda dialect: database.delete_sessions_statements(dialect, Session.token == 'token')),
+    ('delete_expired_sessions', lambda dialect: database.delete_sessions_statements(
+        dialect,
+        *database.oldest_sessions_filter(Session.created_at, NOW, 500)
+    )),
+    ('delete_users', lambda dialect: database.delete_users_statements([1])),
+    ('modify_users', modify_users_statements),
+    ('list_users', lambda dialect: [database.list_users_statement(after_id=1, limit=100)]),
+    ('list_sessions', lambda dialect: [database.list_sessions_statement()]),
+    ('online_user_ids', lambda dialect: [database.online_user_ids_statement()]),
+    ('count_online_users', lambda dialect: [database.count_online_users_statement()]),
+    ('is_user_online', lambda dialect: [database.is_user_online_statement(1)])
+]
+
+FULL_SCANS_ALLOWED = {'list_sessions', 'online_user_ids', 'count_online_users'}
+
+
+def is_full_scan(line):
+    return 'Seq Scan' in line or (line.startswith('SCAN ') and 'INDEX' not in line)
+
+
+def capture_plans(connection, statements):
+    """Returns the SQL and plan lines of each statement. The statements are
+    only explained, never run."""
+    prefix = EXPLAIN_PREFIXES[connection.dialect.name]
+    plans = []
+
+    for statement in statements:
+        sql = str(statement.compile(dialect=connection.dialect, compile_kwargs={'literal_binds': True}))
+        plan = connection.exec_driver_sql(prefix + sql).fetchall()
+        plans.append((sql, [str(row[-1]) for row in plan]))
+
+    return plans
+
+
+def explain_queries(engine, out=print):
+    """Print the plan of every query function. Returns the names of the
+    functions that fell back to a full table scan."""
+    regressions = []
+
+    with engine.connect() as connection:
+        if engine.dialect.name == 'postgresql':
+            # Only fall back to a sequential scan when no index can be used
+            connection.exec_driver_sql('SET LOCAL enable_seqscan = off')
+
+        for name, statements in QUERIES:
+            out(f'== {name}')
+
+            for sql, plan in capture_plans(connection, statements(engine.dialect)):
+                out(sql)
+
+                for line in plan:
+                    out(f'    {line}')
+
+                    if is_full_scan(line) and name not in FULL_SCANS_ALLOWED and name not in regressions:
+                        regressions.append(name)
+
+            out('')
+
+        connection.rollback()
+
+    return regressions
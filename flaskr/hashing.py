@@ -0,0 +1,225 @@
+from concurrent.futures import ProcessPoolExecutor
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class PoolSaturated(Exception):
+    pass
+
+
+class LegacySha256Hasher():
+    """The original username-salted SHA-256 scheme, kept only so old
+    hashes can still be verified and then upgraded."""
+
+    name = 'sha256'
+
+    def hash(self, password, salt_source):
+        salt = str.encode(hashlib.sha256(str.encode(salt_source)).hexdigest())
+        return hashlib.sha256(str.encode(password) + salt).hexdigest()
+
+    def verify(self, password, stored, salt_source):
+        return hmac.compare_digest(self.hash(password, salt_source), stored)
+
+    def identifies(self, stored):
+        return len(stored) == 64 and '$' not in stored
+
+
+class ScryptHasher():
+    """Memory-hard scrypt with a random salt. cost is log2 of scrypt's N."""
+
+    name = 'scrypt'
+
+    def __init__(self, cost=14, r=8, p=1):
+        self.cost = cost
+        self.r = r
+        self.p = p
+
+    def derive(self, password, salt, cost, r, p):
+        n = 2 ** cost
+        return hashlib.scrypt(
+            str.encode(password),
+            salt=salt,
+            n=n,
+            r=r,
+            p=p,
+            maxmem=256 * r * n,
+            dklen=32
+        )
+
+    def hash(self, password, salt_source=None):
+        salt = os.urandom(16)
+        key = self.derive(password, salt, self.cost, self.r, self.p)
+
+        return '$'.join([
+            self.name,
+            str(self.cost),
+            str(self.r),
+            str(self.p),
+            base64.b64encode(salt).decode(),
+            base64.b64encode(key).decode()
+        ])
+
+    def verify(self, password, stored, salt_source=None):
+        _, cost, r, p, salt, key = stored.split('$')
+        derived = self.derive(password, base64.b64decode(salt), int(cost), int(r), int(p))
+
+        return hmac.compare_digest(derived, base64.b64decode(key))
+
+    def identifies(self, stored):
+        return stored.startswith(self.name + '$')
+
+    def needs_rehash(self, stored):
+        # Only upgrade: a host configured with a lower cost must not weaken
+        # hashes made elsewhere, or users would flip between costs
+        _, cost, r, p, _, _ = stored.split('$')
+        return int(cost) < self.cost or int(r) < self.r or int(p) < self.p
+
+
+LEGACY_HASHER = LegacySha256Hasher()
+
+hasher = ScryptHasher()
+
+
+def compute_hash(hasher, password, salt_source):
+    return hasher.hash(password, salt_source)
+
+
+def compute_verify(hasher, password, stored, salt_source):
+    return hasher.verify(password, stored, salt_source)
+
+
+class HashingPool():
+    """Runs hashes in a bounded process pool so they don't hold the GIL of
+    request threads. At most max_pending hashes may be queued; callers that
+    can't get a slot within timeout get PoolSaturated."""
+
+    def __init__(self, max_workers=2, max_pending=32, timeout=1.0):
+        self.configure(max_workers, max_pending, timeout)
+
+    def configure(self, max_workers, max_pending, timeout):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def executor(self):
+        # Each uWSGI worker gets its own pool; one inherited across a fork is unusable
+        with self._lock:
+            if self._executor == None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+                self._pid = os.getpid()
+
+            return self._executor
+
+    def run(self, func, *args):
+        if self.max_workers == 0:
+            return func(*args)
+
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolSaturated()
+
+        try:
+            return self.executor().submit(func, *args).result()
+        finally:
+            self._slots.release()
+
+    def map(self, func, *iterables):
+        if self.max_workers == 0:
+            return list(map(func, *iterables))
+
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolSaturated()
+
+        try:
+            return list(self.executor().map(func, *iterables, chunksize=16))
+        finally:
+            self._slots.release()
+
+
+pool = HashingPool()
+
+# Bulk imports get their own pool, and optionally a cheaper hasher, so a
+# large import neither waits behind logins nor holds them up
+bulk_pool = HashingPool()
+bulk_hasher = hasher
+
+
+def calibrate(budget_seconds, max_cost=20):
+    """Return the highest scrypt cost whose hash fits in the latency budget."""
+    cost = 10
+
+    while cost < max_cost:
+        start = time.perf_counter()
+        ScryptHasher(cost=cost + 1).hash('calibration')
+
+        if time.perf_counter() - start > budget_seconds:
+            break
+
+        cost += 1
+
+    return cost
+
+
+def configure(cost=None, budget_seconds=0.05, max_workers=2, max_pending=32, timeout=1.0, bulk_cost=None, bulk_workers=None):
+    global hasher, bulk_hasher
+
+    if cost == None:
+        cost = calibrate(budget_seconds)
+
+    logger.info('Using scrypt with cost %d', cost)
+
+    hasher = ScryptHasher(cost=cost)
+    pool.configure(max_workers, max_pending, timeout)
+
+    # Weaker bulk hashes are upgraded by needs_rehash on the user's first login
+    bulk_hasher = hasher if bulk_cost == None else ScryptHasher(cost=bulk_cost)
+    bulk_pool.configure(bulk_workers if bulk_workers != None else os.cpu_count(), max_pending, timeout)
+
+
+def hash_password(password, salt_source):
+    return pool.run(compute_hash, hasher, password, salt_source)
+
+
+def hash_passwords(passwords, salt_sources):
+    return bulk_pool.map(compute_hash, [bulk_hasher] * len(passwords), passwords, salt_sources)
+
+
+def find_hasher(stored):
+    if stored == None:
+        return None
+
+    if hasher.identifies(stored):
+        return hasher
+
+    if LEGACY_HASHER.identifies(stored):
+        return LEGACY_HASHER
+
+    return None
+
+
+def verify_password(password, stored, salt_source):
+    found = find_hasher(stored)
+
+    if found == None:
+        return False
+
+    if found is LEGACY_HASHER:
+        # Cheap enough to run inline
+        return found.verify(password, stored, salt_source)
+
+    return pool.run(compute_verify, found, password, stored, salt_source)
+
+
+def needs_rehash(stored):
+    found = find_hasher(stored)
+    return found is LEGACY_HASHER or (found is hasher and hasher.needs_rehash(stored))
@@ -0,0 +1,162 @@
+from logging.handlers import QueueHandler, QueueListener
+from flaskr.pool import after_fork
+import atexit
+import datetime as dt
+import json
+import logging
+import queue
+import random
+import sys
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            'time': dt.datetime.fromtimestamp(record.created, dt.timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'process': record.process,
+            'thread': record.threadName
+        }
+
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str)
+
+
+class LazyQueueHandler(QueueHandler):
+    """Queue handler that leaves formatting to the background writer.
+
+    The stock QueueHandler formats the message in the calling thread; this one
+    only enqueues the record, so the request thread never pays for string
+    formatting or handler I/O. Records are dropped, and counted, when the
+    queue is full instead of blocking the request.
+    """
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BoundedQueueListener(QueueListener):
+    """Queue listener that can be stopped while its bounded queue is full.
+
+    The stock listener adds its stop sentinel with put_nowait, which raises
+    queue.Full under load. This one waits up to STOP_TIMEOUT seconds for the
+    writer to make room, then drops the oldest queued records to fit it.
+    """
+
+    STOP_TIMEOUT = 5.0
+
+    def enqueue_sentinel(self):
+        try:
+            self.queue.put(self._sentinel, timeout=self.STOP_TIMEOUT)
+            return
+        except queue.Full:
+            pass
+
+        while True:
+            try:
+                self.queue.put_nowait(self._sentinel)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+
+class SamplingFilter(logging.Filter):
+    """Let through only a fraction of the records of a high-volume logger."""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return self.rate >= 1 or random.random() < self.rate
+
+
+listener = None
+queue_handler = None
+
+
+def setup_logging(config, stream=None):
+    """Route all logging through a queue to a background JSON-lines writer.
+
+    Reads LOG_LEVEL, LOG_LEVELS (logger name -> level), LOG_SAMPLING (logger
+    name -> fraction of records to keep) and LOG_QUEUE_SIZE from config.
+    """
+    global listener, queue_handler
+
+    if listener != None:
+        listener.stop()
+
+    records = queue.Queue(maxsize=config.get('LOG_QUEUE_SIZE', 10000))
+
+    writer = logging.StreamHandler(stream or sys.stderr)
+    writer.setFormatter(JsonFormatter())
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    queue_handler = LazyQueueHandler(records)
+    root.addHandler(queue_handler)
+    root.setLevel(config.get('LOG_LEVEL', 'INFO'))
+
+    for name, level in config.get('LOG_LEVELS', {}).items():
+        logging.getLogger(name).setLevel(level)
+
+    # Replace the sampling of an earlier call rather than compounding it
+    for existing in [root, *logging.root.manager.loggerDict.values()]:
+        for sampler in [f for f in getattr(existing, 'filters', []) if isinstance(f, SamplingFilter)]:
+            existing.removeFilter(sampler)
+
+    for name, rate in config.get('LOG_SAMPLING', {}).items():
+        logging.getLogger(name).addFilter(SamplingFilter(rate))
+
+    listener = BoundedQueueListener(records, writer, respect_handler_level=True)
+    listener.start()
+
+    return listener
+
+
+def stop_logging():
+    global listener
+
+    if listener != None:
+        listener.stop()
+        listener = None
+
+
+def restart_listener_after_fork():
+    # The writer thread doesn't survive a fork, and the queue's lock may have
+    # been held by it at fork time, so workers forked from the master get a
+    # fresh queue and writer thread of their own.
+    global listener
+
+    if listener == None:
+        return
+
+    records = queue.Queue(maxsize=queue_handler.queue.maxsize)
+    queue_handler.queue = records
+
+    listener = BoundedQueueListener(records, *listener.handlers, respect_handler_level=True)
+    listener.start()
+
+
+atexit.register(stop_logging)
+after_fork(restart_listener_after_fork)
@@ -0,0 +1,264 @@
+"""Per-resource request metrics shared by every worker, in Prometheus format.
+
+Each worker process claims its own block of float64 counters in a shared
+memory-mapped file and only ever adds to that block, so recording a request
+is a handful of in-memory additions with no cross-process locking. /metrics
+sums the blocks of all workers. A block left behind by a dead worker is
+taken over by the next one, so counters stay monotonic across restarts.
+
+Database numbers come from cursor execute events and are charged to the
+request running in the current context (thread or asyncio task).
+"""
+from flaskr.shared import SharedMemory
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import bisect
+import contextvars
+import hashlib
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+STATUSES = (200, 201, 204, 304, 400, 401, 403, 404, 405, 409, 413, 415, 429, 500, 502, 503, 504)
+
+# Upper bounds in seconds, as in the Prometheus client defaults
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+WORKER_SLOTS = 64
+
+# Offsets within a resource's block: one counter per status plus one for
+# any other status, a counter per bucket plus +Inf, then the totals
+STATUS_OFFSET = 0
+BUCKET_OFFSET = len(STATUSES) + 1
+LATENCY_SUM_OFFSET = BUCKET_OFFSET + len(BUCKETS) + 1
+DB_QUERIES_OFFSET = LATENCY_SUM_OFFSET + 1
+DB_SECONDS_OFFSET = LATENCY_SUM_OFFSET + 2
+BLOCK_SIZE = LATENCY_SUM_OFFSET + 3
+
+# [queries, seconds] of the request running in this context
+current_request = contextvars.ContextVar('current_request', default=None)
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+class RequestMetrics():
+    def __init__(self, path, resources, worker_slots=WORKER_SLOTS):
+        self.resources = {name: index for index, name in enumerate(resources)}
+        self.status_index = {status: index for index, status in enumerate(STATUSES)}
+        self.worker_slots = worker_slots
+        # The worker's pid, then one block per resource
+        self.stride = 1 + len(resources) * BLOCK_SIZE
+        # A file written with a different layout is reset on first use
+        layout = repr((list(resources), STATUSES, BUCKETS, worker_slots)).encode()
+        self.fingerprint = float(int.from_bytes(hashlib.blake2b(layout, digest_size=6).digest(), 'little'))
+        self.memory = SharedMemory(path, 8 * (1 + worker_slots * self.stride))
+        self._view = None
+        self._view_pid = None
+        self._base = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def view(self):
+        if self._view_pid != os.getpid():
+            self._view = memoryview(self.memory.open()).cast('d')
+            self._view_pid = os.getpid()
+
+        return self._view
+
+    def claim(self):
+        pid = os.getpid()
+        base = None
+
+        with self.memory.lock() as memory:
+            view = memoryview(memory).cast('d')
+
+            if view[0] != self.fingerprint:
+                memory[:] = bytes(len(memory))
+                view[0] = self.fingerprint
+
+            owners = [int(view[1 + slot * self.stride]) for slot in range(self.worker_slots)]
+
+            if pid in owners:
+                base = 1 + owners.index(pid) * self.stride
+            else:
+                for slot, owner in enumerate(owners):
+                    if owner == 0 or not process_alive(owner):
+                        base = 1 + slot * self.stride
+                        view[base] = pid
+                        break
+
+            view.release()
+
+        if base == None:
+            logger.warning('No free metrics slot for worker %d; its requests won\'t be counted', pid)
+
+        self._base = base
+        self._pid = pid
+
+    def record(self, resource, status, seconds, queries, db_seconds):
+        index = self.resources.get(resource)
+
+        if index == None:
+            return
+
+        if self._pid != os.getpid():
+            self.claim()
+
+        if self._base == None:
+            return
+
+        view = self.view()
+        offset = self._base + 1 + index * BLOCK_SIZE
+
+        with self._lock:
+            view[offset + STATUS_OFFSET + self.status_index.get(status, len(STATUSES))] += 1
+            view[offset + BUCKET_OFFSET + bisect.bisect_left(BUCKETS, seconds)] += 1
+            view[offset + LATENCY_SUM_OFFSET] += seconds
+            view[offset + DB_QUERIES_OFFSET] += queries
+            view[offset + DB_SECONDS_OFFSET] += db_seconds
+
+    def collect(self):
+        """Sum every worker's block. Returns resource -> list of counters."""
+        view = self.view()
+
+        if view[0] != self.fingerprint:
+            return {resource: [0.0] * BLOCK_SIZE for resource in self.resources}
+
+        totals = {}
+
+        for resource, index in self.resources.items():
+            block = [0.0] * BLOCK_SIZE
+
+            for slot in range(self.worker_slots):
+                offset = 1 + slot * self.stride + 1 + index * BLOCK_SIZE
+
+                for i in range(BLOCK_SIZE):
+                    block[i] += view[offset + i]
+
+            totals[resource] = block
+
+        return totals
+
+
+def format_labels(labels):
+    return ','.join(f'{name}="{value}"' for name, value in labels)
+
+
+def format_value(value):
+    return repr(int(value)) if value == int(value) else repr(value)
+
+
+def render(totals):
+    """Render collected totals in the Prometheus text exposition format."""
+    lines = [
+        '# HELP flaskr_requests_total Requests handled, by resource and status code.',
+        '# TYPE flaskr_requests_total counter'
+    ]
+
+    for resource, block in totals.items():
+        for index, status in enumerate(STATUSES + ('other',)):
+            if block[STATUS_OFFSET + index] > 0:
+                lines.append(f'flaskr_requests_total{{{format_labels([("resource", resource), ("status", status)])}}} {format_value(block[STATUS_OFFSET + index])}')
+
+    lines += [
+        '# HELP flaskr_request_duration_seconds Time spent handling requests, by resource.',
+        '# TYPE flaskr_request_duration_seconds histogram'
+    ]
+
+    for resource, block in totals.items():
+        cumulative = 0.0
+
+        for index, bound in enumerate(BUCKETS + ('+Inf',)):
+            cumulative += block[BUCKET_OFFSET + index]
+            lines.append(f'flaskr_request_duration_seconds_bucket{{{format_labels([("resource", resource), ("le", bound)])}}} {format_value(cumulative)}')
+
+        lines.append(f'flaskr_request_duration_seconds_sum{{{format_labels([("resource", resource)])}}} {format_value(block[LATENCY_SUM_OFFSET])}')
+        lines.append(f'flaskr_request_duration_seconds_count{{{format_labels([("resource", resource)])}}} {format_value(cumulative)}')
+
+    lines += [
+        '# HELP flaskr_db_queries_total SQL statements executed while handling requests, by resource.',
+        '# TYPE flaskr_db_queries_total counter'
+    ]
+    lines += [
+        f'flaskr_db_queries_total{{{format_labels([("resource", resource)])}}} {format_value(block[DB_QUERIES_OFFSET])}'
+        for resource, block in totals.items()
+    ]
+
+    lines += [
+        '# HELP flaskr_db_seconds_total Time spent in SQL statements while handling requests, by resource.',
+        '# TYPE flaskr_db_seconds_total counter'
+    ]
+    lines += [
+        f'flaskr_db_seconds_total{{{format_labels([("resource", resource)])}}} {format_value(block[DB_SECONDS_OFFSET])}'
+        for resource, block in totals.items()
+    ]
+
+    return '\n'.join(lines) + '\n'
+
+
+metrics = None
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_request.get() != None:
+        conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current_request.get()
+
+    if stats == None or not conn.info.get('metrics_query_start'):
+        return
+
+    stats[0] += 1
+    stats[1] += time.perf_counter() - conn.info['metrics_query_start'].pop()
+
+
+def configure(path, resources):
+    global metrics
+
+    if metrics == None:
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+
+    metrics = RequestMetrics(path, resources)
+
+
+def start_request():
+    """Start timing a request. Returns the value to pass to finish_request."""
+    if metrics == None:
+        return None
+
+    current_request.set([0, 0.0])
+
+    return time.perf_counter()
+
+
+def finish_request(started, resource, status):
+    stats = current_request.get()
+
+    if metrics == None or started == None or stats == None:
+        return
+
+    current_request.set(None)
+    metrics.record(resource, status, time.perf_counter() - started, stats[0], stats[1])
+
+
+def export():
+    if metrics == None:
+        return ''
+
+    return render(metrics.collect())
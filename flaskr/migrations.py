@@ -0,0 +1,108 @@
+from flaskr.database import db, User, Session
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, insert, select, update
+import datetime as dt
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# Kept out of db.metadata so create_all() never touches it
+metadata = MetaData()
+
+schema_version = Table(
+    'schema_version',
+    metadata,
+    Column('version', Integer, primary_key=True),
+    Column('description', String(255)),
+    Column('applied_at', DateTime)
+)
+
+
+def create_tables(connection):
+    db.metadata.create_all(bind=connection, tables=[User.__table__, Session.__table__])
+
+
+def create_indexes(*names):
+    def upgrade(connection):
+        for table in (User.__table__, Session.__table__):
+            for index in table.indexes:
+                if index.name in names:
+                    index.create(bind=connection, checkfirst=True)
+
+    return upgrade
+
+
+def drop_indexes(*names):
+    def upgrade(connection):
+        preparer = connection.dialect.identifier_preparer
+
+        for table in (User.__table__, Session.__table__):
+            existing = {index['name'] for index in inspect(connection).get_indexes(table.name)}
+
+            for name in names:
+                if name in existing:
+                    connection.exec_driver_sql(f'DROP INDEX {preparer.quote(name)}')
+
+    return upgrade
+
+
+def add_session_last_seen_at(connection):
+    # Tables created by migration 1 from the current models already have it
+    columns = [column['name'] for column in inspect(connection).get_columns(Session.__table__.name)]
+
+    if 'last_seen_at' not in columns:
+        table = connection.dialect.identifier_preparer.quote(Session.__table__.name)
+        connection.exec_driver_sql(f'ALTER TABLE {table} ADD COLUMN last_seen_at TIMESTAMP')
+
+    connection.execute(
+        update(Session.__table__).
+        where(Session.last_seen_at == None).
+        values(last_seen_at=Session.created_at)
+    )
+
+    create_indexes('ix_session_last_seen_at')(connection)
+
+
+# Append only: each entry runs once, in order, in its own transaction.
+MIGRATIONS = [
+    (1, 'Create the user and session tables', create_tables),
+    (2, 'Index session tokens, session age and user credentials', create_indexes(
+        'ix_session_token',
+        'ix_session_created_at',
+        'ix_user_credentials'
+    )),
+    (3, 'Track session activity for the idle timeout', add_session_last_seen_at),
+    # Logins look users up by username and verify the hash in Python
+    (4, 'Drop the unused user credentials index', drop_indexes('ix_user_credentials'))
+]
+
+
+def applied_versions(engine):
+    with engine.begin() as connection:
+        schema_version.create(bind=connection, checkfirst=True)
+
+        return set(connection.execute(select(schema_version.c.version)).scalars())
+
+
+def migrate(engine):
+    """Apply pending migrations. Returns the versions that were applied."""
+    applied = applied_versions(engine)
+    result = []
+
+    for version, description, upgrade in MIGRATIONS:
+        if version in applied:
+            continue
+
+        logger.info('Applying migration %d: %s', version, description)
+
+        with engine.begin() as connection:
+            upgrade(connection)
+            connection.execute(insert(schema_version).values(
+                version=version,
+                description=description,
+                applied_at=dt.datetime.now()
+            ))
+
+        result.append(version)
+
+    return result
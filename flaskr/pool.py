@@ -0,0 +1,205 @@
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+import logging
+import os
+import threading
+import time
+import weakref
+
+
+logger = logging.getLogger(__name__)
+
+pools = weakref.WeakSet()
+
+# Run in each new worker process; see after_fork
+worker_hooks = []
+
+
+class PoolMetrics():
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._lock = threading.Lock()
+
+    def record_wait(self, seconds, timed_out=False):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+            if timed_out:
+                self.timeouts += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_total_seconds': self.wait_total,
+                'wait_max_seconds': self.wait_max,
+                'wait_avg_seconds': self.wait_total / self.checkouts if self.checkouts > 0 else 0.0
+            }
+
+
+class MeteredQueuePool(QueuePool):
+    """QueuePool that records how long callers wait to check out a connection."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+        pools.add(self)
+
+    def recreate(self):
+        # The engine swaps this pool for the new one, e.g. in dispose(); a
+        # replaced pool is gone from the engine even while objects hold it
+        pools.discard(self)
+        return super().recreate()
+
+    def _do_get(self):
+        start = time.perf_counter()
+
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.metrics.record_wait(time.perf_counter() - start, timed_out=True)
+            raise
+
+        self.metrics.record_wait(time.perf_counter() - start)
+
+        return connection
+
+    def stats(self):
+        capacity = None
+        saturation = None
+
+        if self._max_overflow >= 0:
+            capacity = self.size() + self._max_overflow
+            saturation = self.checkedout() / capacity
+
+        return self.metrics.snapshot() | {
+            'size': self.size(),
+            'max_overflow': self._max_overflow,
+            'checked_out': self.checkedout(),
+            'checked_in': self.checkedin(),
+            'overflow': self.overflow(),
+            'capacity': capacity,
+            'saturation': saturation
+        }
+
+
+@event.listens_for(MeteredQueuePool, 'connect')
+def remember_owner(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+@event.listens_for(MeteredQueuePool, 'checkout')
+def discard_inherited_connection(dbapi_connection, connection_record, connection_proxy):
+    # A connection opened before a uWSGI fork belongs to the master; drop it
+    # without closing the shared socket and let the pool open a fresh one.
+    if connection_record.info.get('pid') != os.getpid():
+        connection_record.dbapi_connection = connection_proxy.dbapi_connection = None
+        raise exc.DisconnectionError('Connection was opened by a different process')
+
+
+def pool_stats():
+    return {
+        'pid': os.getpid(),
+        'pools': [pool.stats() for pool in list(pools)]
+    }
+
+
+def prewarm(engine, connections):
+    """Open connections pool connections at once, check each with a trivial
+    query and hand them back to the pool. Returns how many were opened."""
+    opened = []
+    validated = 0
+
+    try:
+        for _ in range(connections):
+            connection = engine.connect()
+            opened.append(connection)
+            connection.exec_driver_sql('SELECT 1')
+            validated += 1
+    except exc.SQLAlchemyError as e:
+        # Not fatal: requests open connections on demand, with pre-ping
+        logger.warning('Pre-warming the %s pool stopped after %d connections: %r', engine.dialect.name, validated, e)
+    finally:
+        for connection in opened:
+            connection.close()
+
+    return validated
+
+
+def after_fork(hook):
+    """Run hook in each worker right after it's forked. uWSGI does that
+    through its postfork chain; other preforking servers must call
+    run_worker_hooks() from their own hook, e.g. gunicorn's post_fork.
+
+    os.register_at_fork would also fire in the password hashing pool's
+    processes, which never touch the database."""
+    worker_hooks.append(hook)
+
+    try:
+        from uwsgidecorators import postfork
+    except ImportError:
+        return
+
+    postfork(hook)
+
+
+def run_worker_hooks():
+    for hook in worker_hooks:
+        hook()
+
+
+def prewarm_after_fork(app, db, connections=None):
+    """Fill every engine's pool in each forked worker before it takes
+    requests. connections=None opens the engine's pool_size."""
+    if connections == 0:
+        return
+
+    def prewarm_worker():
+        started = time.perf_counter()
+        opened = 0
+
+        with app.app_context():
+            for engine in db.engines.values():
+                # Connections the master opened are its own; forget them
+                # without closing the sockets it still uses
+                engine.dispose(close=False)
+
+                if not isinstance(engine.pool, QueuePool):
+                    continue
+
+                opened += prewarm(engine, connections if connections != None else engine.pool.size())
+
+        logger.info('Pre-warmed %d database connections in %.1f ms', opened, (time.perf_counter() - started) * 1000)
+
+    after_fork(prewarm_worker)
+
+
+def env_flag(name, default):
+    value = os.environ.get(name)
+
+    if value == None:
+        return default
+
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+def engine_options_from_env(url):
+    """Build SQLALCHEMY_ENGINE_OPTIONS from DB_POOL_* environment variables."""
+    if url.startswith('sqlite') and ':memory:' in url:
+        # In-memory SQLite needs its default single-connection pool
+        return {}
+
+    return {
+        'poolclass': MeteredQueuePool,
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', -1)),
+        'pool_pre_ping': env_flag('DB_POOL_PRE_PING', True)
+    }
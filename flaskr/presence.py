@@ -0,0 +1,208 @@
+"""Which users are online, answerable in constant time by any worker.
+
+A user is online while they have a live session, as listed by
+/onlineusers. Their ids are kept in a linear-probing hash set in shared
+memory, next to their count, and every write that creates or deletes
+sessions updates it after committing, so /onlineusers/count and
+/onlineusers/<id> never touch the database. A session that expires stays
+counted until the sweeper deletes it, at most SESSION_SWEEP_INTERVAL
+seconds late.
+
+Each start of the app rebuilds the set from the session table, which also
+repairs any drift, e.g. from sessions deleted by hand. Until a rebuild has
+succeeded, or if the set outgrows its slots, callers get None and fall back
+to querying the database. Like the other shared state, the set covers the
+writes of one host.
+"""
+from flaskr.shared import SharedMemory, runtime_path
+import contextlib
+import logging
+import struct
+
+
+logger = logging.getLogger(__name__)
+
+# online users, state
+HEADER = struct.Struct('QQ')
+
+# user id; 0 marks an empty slot
+SLOT = struct.Struct('Q')
+
+STALE = 0
+READY = 1
+# More users than fit under the load limit; stays until a rebuild
+OVERFLOWED = 2
+
+MULTIPLIER = 0x9E3779B97F4A7C15
+
+
+class PresenceRegistry():
+    def __init__(self, path, slots):
+        self.slots = slots
+        # Probe sequences stay short below this load
+        self.max_count = slots * 3 // 4
+        self.memory = SharedMemory(path, HEADER.size + SLOT.size * slots)
+
+    def home(self, user_id):
+        # Fibonacci hashing spreads sequential ids across the table
+        return ((user_id * MULTIPLIER) & 0xFFFFFFFFFFFFFFFF) % self.slots
+
+    def offset(self, index):
+        return HEADER.size + SLOT.size * index
+
+    def get(self, memory, index):
+        return SLOT.unpack_from(memory, self.offset(index))[0]
+
+    def find(self, memory, user_id):
+        """Index of user_id's slot, or of the empty slot it would go in."""
+        index = self.home(user_id)
+
+        while True:
+            value = self.get(memory, index)
+
+            if value == user_id or value == 0:
+                return index, value == user_id
+
+            index = (index + 1) % self.slots
+
+    def insert(self, memory, user_id):
+        count, state = HEADER.unpack_from(memory, 0)
+        index, found = self.find(memory, user_id)
+
+        if found:
+            return
+
+        if count >= self.max_count:
+            if state != OVERFLOWED:
+                logger.warning('Presence registry is full at %d users; counting online users in the database', count)
+            HEADER.pack_into(memory, 0, count, OVERFLOWED)
+            return
+
+        SLOT.pack_into(memory, self.offset(index), user_id)
+        HEADER.pack_into(memory, 0, count + 1, state)
+
+    def remove(self, memory, user_id):
+        count, state = HEADER.unpack_from(memory, 0)
+        hole, found = self.find(memory, user_id)
+
+        if not found:
+            return
+
+        # Backward-shift deletion: pull later entries of the probe run into
+        # the hole unless that would put them before their home slot
+        index = hole
+
+        while True:
+            index = (index + 1) % self.slots
+            value = self.get(memory, index)
+
+            if value == 0:
+                break
+
+            home = self.home(value)
+
+            if (hole < index and hole < home <= index) or (hole > index and (home > hole or home <= index)):
+                continue
+
+            SLOT.pack_into(memory, self.offset(hole), value)
+            hole = index
+
+        SLOT.pack_into(memory, self.offset(hole), 0)
+        HEADER.pack_into(memory, 0, count - 1, state)
+
+    def add(self, user_ids):
+        with self.memory.lock() as memory:
+            for user_id in user_ids:
+                self.insert(memory, user_id)
+
+    def discard(self, user_ids):
+        with self.memory.lock() as memory:
+            for user_id in user_ids:
+                self.remove(memory, user_id)
+
+    @contextlib.contextmanager
+    def rebuilding(self):
+        """Lock the registry for a rebuild and yield replace(user_ids), which
+        swaps in the given ids and returns their count. The lock is held
+        throughout, so updates for writes committed meanwhile are applied
+        after it, whether or not the loaded ids include them."""
+        with self.memory.lock() as memory:
+            def replace(user_ids):
+                memory[:] = bytes(len(memory))
+                HEADER.pack_into(memory, 0, 0, READY)
+
+                for user_id in user_ids:
+                    self.insert(memory, user_id)
+
+                count = HEADER.unpack_from(memory, 0)[0]
+                logger.info('Rebuilt the presence registry: %d users online', count)
+
+                return count
+
+            try:
+                yield replace
+            except Exception:
+                # What's there may have drifted; empty and stale, the
+                # registry sends callers to the database
+                memory[:] = bytes(len(memory))
+                raise
+
+    def rebuild(self, load):
+        """Replace the contents with the ids load() returns."""
+        with self.rebuilding() as replace:
+            return replace(load())
+
+    def count(self):
+        with self.memory.lock() as memory:
+            count, state = HEADER.unpack_from(memory, 0)
+
+        return count if state == READY else None
+
+    def contains(self, user_id):
+        with self.memory.lock() as memory:
+            if HEADER.unpack_from(memory, 0)[1] != READY:
+                return None
+
+            return self.find(memory, user_id)[1]
+
+
+registry = PresenceRegistry(runtime_path('presence'), slots=1 << 18)
+
+
+def configure(path, slots):
+    global registry
+
+    registry = PresenceRegistry(path, slots)
+
+
+def rebuild(load):
+    """Rebuild from load(), which returns the ids of the online users.
+    Returns whether it succeeded; if not, the registry stays unusable."""
+    try:
+        registry.rebuild(load)
+    except Exception as e:
+        # E.g. before the first migration
+        logger.warning('Couldn\'t rebuild the presence registry: %r', e)
+        return False
+
+    return True
+
+
+def user_online(user_id):
+    # Sessions without a user don't make anyone online
+    if user_id != None:
+        registry.add([user_id])
+
+
+def users_offline(user_ids):
+    registry.discard([user_id for user_id in user_ids if user_id != None])
+
+
+def count():
+    """Number of online users, or None if the registry can't tell."""
+    return registry.count()
+
+
+def is_online(user_id):
+    """Whether the user is online, or None if the registry can't tell."""
+    return registry.contains(user_id)
@@ -0,0 +1,186 @@
+"""Opt-in profiling of individual requests.
+
+A request is profiled when it carries the profiling header with the
+configured secret, or when it's picked by the sampling rate. For each
+profiled request three files are written to PROFILE_DIR:
+
+- <id>.prof    cProfile stats, for pstats or snakeviz
+- <id>.folded  sampled call stacks in the folded format read by
+               flamegraph.pl and speedscope; a statement running at sample
+               time shows up as a "SQL: ..." leaf frame
+- <id>.txt     the request, its SQL statements with their times and the
+               top functions by cumulative time
+
+Nothing is hooked into the app unless PROFILE_DIR is set, so a disabled
+profiler costs nothing.
+"""
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import collections
+import contextvars
+import cProfile
+import hmac
+import io
+import logging
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# Profile of the request running in this context
+current_profile = contextvars.ContextVar('current_profile', default=None)
+
+
+class RequestProfile():
+    def __init__(self, profile_id, interval):
+        self.id = profile_id
+        self.interval = interval
+        self.profiler = cProfile.Profile()
+        self.statements = []
+        self.current_sql = None
+        self.stacks = collections.Counter()
+        self._thread_id = threading.get_ident()
+        self._done = threading.Event()
+        self._sampler = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._sampler = threading.Thread(target=self.sample, name='request-profiler', daemon=True)
+        self._sampler.start()
+        self.profiler.enable()
+
+    def stop(self):
+        # Stop sampling first so the wait for the sampler isn't in the stacks
+        self._done.set()
+        self._sampler.join()
+        self.profiler.disable()
+        self.elapsed = time.perf_counter() - self.started
+
+    def sample(self):
+        while not self._done.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+
+            if frame != None:
+                self.stacks[self.fold(frame)] += 1
+
+    def fold(self, frame):
+        names = []
+
+        while frame != None:
+            code = frame.f_code
+            names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+            frame = frame.f_back
+
+        names.reverse()
+
+        sql = self.current_sql
+        if sql != None:
+            names.append('SQL: ' + ' '.join(sql.split())[:120])
+
+        # ; separates frames in the folded format
+        return ';'.join(names)
+
+    def write(self, directory, description):
+        path = os.path.join(directory, self.id)
+
+        self.profiler.dump_stats(f'{path}.prof')
+
+        with open(f'{path}.folded', 'w') as file:
+            for stack, count in self.stacks.items():
+                file.write(f'{stack} {count}\n')
+
+        top = io.StringIO()
+        pstats.Stats(self.profiler, stream=top).sort_stats('cumulative').print_stats(30)
+
+        with open(f'{path}.txt', 'w') as file:
+            file.write(f'{description}\n{self.elapsed * 1000:.2f} ms, {len(self.statements)} SQL statements\n\n')
+
+            for statement, seconds in self.statements:
+                file.write(f'-- {seconds * 1000:.2f} ms\n{statement}\n\n')
+
+            file.write(top.getvalue())
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = current_profile.get()
+
+    if profile != None:
+        profile.current_sql = statement
+        conn.info.setdefault('profile_query_start', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = current_profile.get()
+
+    if profile == None or not conn.info.get('profile_query_start'):
+        return
+
+    profile.current_sql = None
+    profile.statements.append((statement, time.perf_counter() - conn.info['profile_query_start'].pop()))
+
+
+def profile_id():
+    slug = re.sub(r'[^a-zA-Z0-9]+', '-', request.path).strip('-') or 'root'
+    return f'{time.strftime("%Y%m%dT%H%M%S")}-{request.method}-{slug}-{os.getpid()}-{random.getrandbits(24):06x}'
+
+
+def init_app(app):
+    directory = app.config['PROFILE_DIR']
+
+    if not directory:
+        return
+
+    rate = app.config['PROFILE_SAMPLE_RATE']
+    header = app.config['PROFILE_HEADER']
+    secret = app.config['PROFILE_SECRET']
+    interval = app.config['PROFILE_SAMPLE_INTERVAL']
+
+    os.makedirs(directory, exist_ok=True)
+
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+
+    def requested():
+        value = request.headers.get(header)
+        return secret and value != None and hmac.compare_digest(value, secret)
+
+    @app.before_request
+    def start_profile():
+        if not (requested() or random.random() < rate):
+            return
+
+        profile = RequestProfile(profile_id(), interval)
+        g.profile = profile
+        current_profile.set(profile)
+        profile.start()
+
+    @app.after_request
+    def tag_profile(response):
+        if g.get('profile') != None:
+            response.headers['X-Profile-Id'] = g.profile.id
+
+        return response
+
+    @app.teardown_request
+    def finish_profile(error):
+        profile = g.pop('profile', None)
+
+        if profile == None:
+            return
+
+        profile.stop()
+        current_profile.set(None)
+
+        try:
+            profile.write(directory, f'{request.method} {request.full_path}')
+        except OSError as e:
+            logger.warning('Couldn\'t write profile %s: %r', profile.id, e)
+        else:
+            logger.info('Wrote profile %s', profile.id)
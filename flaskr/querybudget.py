@@ -0,0 +1,178 @@
+"""Query budgets and repeated-query detection for tests and debugging.
+
+Every SQL statement issued while a tracker is active is counted. In 'raise'
+mode the statement that would go over the budget raises QueryBudgetExceeded
+instead of running, so a request can't commit writes past its budget; in
+'log' mode the overrun is only logged when the tracker finishes. A statement
+that runs repeatedly within one tracker is logged once with the application
+frames that issued it:
+
+- a SELECT run again with the same parameters is a redundant lookup
+  (a write repeated after a conflict is a retry, not a lookup),
+- the same SQL with different parameters REPEATED_QUERY_THRESHOLD times is
+  the N+1 pattern, a query in a loop that should be one set-based query.
+
+The Flask app wraps each request in a tracker with the route's budget when
+QUERY_BUDGET_MODE is set; tests can use track() directly.
+"""
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import collections
+import contextlib
+import contextvars
+import logging
+import os
+import traceback
+
+
+logger = logging.getLogger(__name__)
+
+# Tracker of the request or block running in this context
+current_tracker = contextvars.ContextVar('current_tracker', default=None)
+
+listening = False
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryTracker():
+    def __init__(self, label, budget=None, repeat_threshold=3, mode='raise'):
+        self.label = label
+        self.budget = budget
+        self.repeat_threshold = repeat_threshold
+        self.mode = mode
+        self.count = 0
+        self.by_statement = collections.Counter()
+        self.by_call = collections.Counter()
+        self.flagged = set()
+        # An enclosing tracker, e.g. a test's around a request's; both count
+        self.outer = None
+
+    def record(self, statement, parameters):
+        self.count += 1
+        self.by_statement[statement] += 1
+
+        try:
+            call = (statement, repr(parameters))
+        except Exception:
+            call = (statement, id(parameters))
+
+        self.by_call[call] += 1
+
+        if self.by_call[call] == 2 and statement.lstrip()[:6].upper() == 'SELECT':
+            self.flag(statement, 'Redundant query: run twice with the same parameters')
+        elif self.by_statement[statement] == self.repeat_threshold:
+            self.flag(statement, f'Possible N+1: run {self.repeat_threshold} times')
+
+    def flag(self, statement, problem):
+        if statement in self.flagged:
+            return
+
+        self.flagged.add(statement)
+        logger.warning('%s in %s\n%s\nIssued from:\n%s', problem, self.label, statement, ''.join(application_stack()))
+
+    def exceeded(self):
+        return self.budget != None and self.count > self.budget
+
+    def message(self):
+        return f'Query budget exceeded in {self.label}: {self.count} statements, budget {self.budget}'
+
+
+def application_stack():
+    # Only this package's frames, minus the tracker itself
+    package = os.path.dirname(__file__)
+    frames = [
+        frame for frame in traceback.extract_stack()
+        if frame.filename.startswith(package) and frame.filename != __file__
+    ]
+
+    return traceback.format_list(frames)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    tracker = current_tracker.get()
+
+    while tracker != None:
+        tracker.record(statement, parameters)
+
+        if tracker.mode == 'raise' and tracker.exceeded():
+            raise QueryBudgetExceeded(tracker.message())
+
+        tracker = tracker.outer
+
+
+def listen():
+    global listening
+
+    if not listening:
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        listening = True
+
+
+def start(label, budget=None, repeat_threshold=3, mode='raise'):
+    listen()
+
+    tracker = QueryTracker(label, budget, repeat_threshold, mode)
+    tracker.outer = current_tracker.get()
+    current_tracker.set(tracker)
+
+    return tracker
+
+
+def finish(tracker):
+    """Stop tracking; raise or log if the budget was exceeded. In 'raise'
+    mode that already failed the statement over it, unless it was caught."""
+    current_tracker.set(tracker.outer)
+
+    if not tracker.exceeded():
+        return
+
+    if tracker.mode == 'raise':
+        raise QueryBudgetExceeded(tracker.message())
+
+    logger.warning(tracker.message())
+
+
+@contextlib.contextmanager
+def track(label, budget=None, repeat_threshold=3, mode='raise'):
+    """Count the statements issued inside the block, e.g. in a test:
+
+        with querybudget.track('login', budget=2):
+            client.post('/login', data=form)
+    """
+    tracker = start(label, budget, repeat_threshold, mode)
+
+    try:
+        yield tracker
+    finally:
+        finish(tracker)
+
+
+def issued():
+    """Statements counted so far by the current tracker, or 0 without one."""
+    tracker = current_tracker.get()
+
+    return tracker.count if tracker != None else 0
+
+
+def allow(count):
+    """Raise the budget of the current tracker, if any, by count statements,
+    for work that grows with the request, e.g. one INSERT per batch."""
+    tracker = current_tracker.get()
+
+    if tracker != None and tracker.budget != None:
+        tracker.budget += count
+
+
+@contextlib.contextmanager
+def untracked():
+    """Issue statements in the block without counting them, e.g. upkeep that
+    happens to run during a request."""
+    token = current_tracker.set(None)
+
+    try:
+        yield
+    finally:
+        current_tracker.reset(token)
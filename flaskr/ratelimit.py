@@ -0,0 +1,120 @@
+"""Token-bucket rate limiting shared by every worker on the host.
+
+Buckets live in a fixed-size open-addressing table in shared memory, so a
+client can't multiply its allowance by landing on different uWSGI workers.
+Each slot holds a key hash, the tokens left and when they were last
+refilled. When a key's probe window is full, the slot refilled longest ago
+is reused; it has the most tokens anyway, so evicting it is the cheapest
+mistake to make.
+"""
+from flaskr.shared import SharedMemory, runtime_path
+import hashlib
+import logging
+import struct
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# key hash, tokens, last refill (unix seconds: the file can outlive a reboot,
+# which resets the monotonic clock)
+SLOT = struct.Struct('Qdd')
+
+PROBE_WINDOW = 8
+
+
+def key_hash(key):
+    # 0 marks an empty slot
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') or 1
+
+
+class RateLimiter():
+    def __init__(self, path, slots):
+        self.slots = slots
+        self.memory = SharedMemory(path, SLOT.size * slots)
+
+    def find_slot(self, memory, hashed):
+        start = hashed % self.slots
+        oldest = None
+
+        for step in range(PROBE_WINDOW):
+            index = (start + step) % self.slots
+            key, tokens, updated = SLOT.unpack_from(memory, index * SLOT.size)
+
+            if key == hashed or key == 0:
+                return index, key == hashed
+
+            if oldest == None or updated < oldest[1]:
+                oldest = (index, updated)
+
+        return oldest[0], False
+
+    def acquire(self, limits, now=None):
+        """Take one token from every (key, burst, per_second) bucket.
+
+        Either all buckets are charged or none are. Returns None if allowed,
+        otherwise the seconds until a retry could succeed.
+        """
+        now = now if now != None else time.time()
+        buckets = []
+
+        with self.memory.lock() as memory:
+            for key, burst, per_second in limits:
+                hashed = key_hash(key)
+                index, found = self.find_slot(memory, hashed)
+
+                if found:
+                    _, tokens, updated = SLOT.unpack_from(memory, index * SLOT.size)
+                    # A clock stepped backwards refills nothing rather than
+                    # draining the bucket
+                    tokens = min(burst, tokens + max(0, now - updated) * per_second)
+                else:
+                    tokens = burst
+
+                # Claimed right away so the next key can't probe into it
+                SLOT.pack_into(memory, index * SLOT.size, hashed, tokens, now)
+                buckets.append((index, hashed, tokens, per_second))
+
+            retry_after = max(
+                ((1 - tokens) / per_second for _, _, tokens, per_second in buckets if tokens < 1),
+                default=None
+            )
+
+            if retry_after == None:
+                for index, hashed, tokens, _ in buckets:
+                    SLOT.pack_into(memory, index * SLOT.size, hashed, tokens - 1, now)
+
+        return retry_after
+
+
+login_limiter = RateLimiter(runtime_path('ratelimit'), slots=8192)
+
+# (burst, tokens per second) for each login key kind; None disables it
+login_limits = {
+    'ip': (20, 1.0),
+    'username': (5, 0.1)
+}
+
+
+def configure(path, slots, ip_limit, username_limit):
+    global login_limiter
+
+    login_limiter = RateLimiter(path, slots)
+    login_limits['ip'] = ip_limit
+    login_limits['username'] = username_limit
+
+
+def check_login(ip, username):
+    """Charge a login attempt to the client's IP and to the username it
+    targets. Returns None if allowed, else seconds until it may retry."""
+    limits = []
+
+    if ip != None and login_limits['ip'] != None:
+        limits.append((f'ip:{ip}', *login_limits['ip']))
+    if username and login_limits['username'] != None:
+        limits.append((f'username:{username.lower()}', *login_limits['username']))
+
+    if len(limits) == 0:
+        return None
+
+    return login_limiter.acquire(limits)
@@ -0,0 +1,193 @@
+"""Routing of reads to replica databases.
+
+Replicas are extra Flask-SQLAlchemy binds, one per DATABASE_REPLICA_URLS
+entry. Reads decorated with flaskr.database.read_from_replica run on one of
+them, round robin, as long as:
+
+- none of the tables they read was written on this host in the last
+  REPLICA_MAX_LAG seconds, so a replica within that lag has every write the
+  primary has served (a user can read back their own write right away),
+- the request hasn't written anything yet, and
+- the replica is healthy: its last check, at most REPLICA_CHECK_INTERVAL
+  seconds ago, answered with a lag under REPLICA_MAX_LAG.
+
+Anything else runs on the primary, as does a read whose replica fails, after
+which the replica sits out REPLICA_RETRY_INTERVAL seconds. Writes and
+on_primary() blocks never touch a replica. To try it with two SQLite files,
+copy the database and point a replica at the copy:
+
+    DATABASE_REPLICA_URLS=sqlite:////tmp/replica.db
+"""
+from flask_sqlalchemy.session import Session
+from sqlalchemy import exc
+import flaskr.querybudget as querybudget
+import flaskr.versions as versions
+import contextlib
+import contextvars
+import itertools
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# Bind key of the replica the running read was routed to
+current_replica = contextvars.ContextVar('current_replica', default=None)
+
+# Set inside on_primary() blocks
+pinned = contextvars.ContextVar('pinned', default=False)
+
+# Seconds the replica is behind its primary; 0 when it has replayed
+# everything it received, since an idle primary sends nothing to replay
+LAG_QUERIES = {
+    'postgresql': '''
+        SELECT CASE
+            WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+        END
+    '''
+}
+
+# Connection-level failures; anything else is a bug in the query, and would
+# fail on the primary too
+CONNECTION_ERRORS = (exc.OperationalError, exc.InterfaceError)
+
+
+def lag_query(dialect):
+    return LAG_QUERIES.get(dialect, 'SELECT 0')
+
+
+class ReplicaSet():
+    def __init__(self, keys=(), max_lag=1.0, check_interval=5.0, retry_interval=30.0):
+        self.keys = list(keys)
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.retry_interval = retry_interval
+        self.checked_at = {}
+        self.down_until = {}
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+
+    def candidates(self, now):
+        """Replicas not sitting out a failure, starting at the next one's turn."""
+        keys = [key for key in self.keys if self.down_until.get(key, 0) <= now]
+
+        if len(keys) == 0:
+            return keys
+
+        start = next(self._turn) % len(keys)
+
+        return keys[start:] + keys[:start]
+
+    def needs_check(self, key, now):
+        checked_at = self.checked_at.get(key)
+
+        return checked_at == None or now - checked_at >= self.check_interval
+
+    def checked(self, key, lag, now):
+        """Record a check's result. Returns whether the replica may serve reads."""
+        if lag > self.max_lag:
+            self.mark_down(key, f'{lag:.2f}s behind the primary', now)
+            return False
+
+        with self._lock:
+            recovered = self.down_until.pop(key, None) != None
+            self.checked_at[key] = now
+
+        if recovered:
+            logger.info('Replica %s is back in rotation', key)
+
+        return True
+
+    def mark_down(self, key, reason, now=None):
+        now = now if now != None else time.monotonic()
+
+        with self._lock:
+            self.down_until[key] = now + self.retry_interval
+            # It has to pass a check before serving again
+            self.checked_at.pop(key, None)
+
+        logger.warning('Replica %s is out of rotation for %ss: %s', key, self.retry_interval, reason)
+
+    def stats(self):
+        now = time.monotonic()
+
+        return {
+            key: {
+                'healthy': self.down_until.get(key, 0) <= now,
+                'checked_seconds_ago': now - self.checked_at[key] if key in self.checked_at else None
+            }
+            for key in self.keys
+        }
+
+
+replica_set = ReplicaSet()
+
+
+def configure(keys, max_lag, check_interval, retry_interval):
+    global replica_set
+
+    replica_set = ReplicaSet(keys, max_lag, check_interval, retry_interval)
+
+
+def may_use_replica(tables):
+    if pinned.get() or len(replica_set.keys) == 0:
+        return False
+
+    return versions.seconds_since_write(*tables) >= replica_set.max_lag
+
+
+def check(key, engine, now):
+    try:
+        # Not the request's own query, and only every REPLICA_CHECK_INTERVAL
+        with querybudget.untracked(), engine.connect() as connection:
+            lag = connection.exec_driver_sql(lag_query(engine.dialect.name)).scalar()
+    except exc.SQLAlchemyError as e:
+        replica_set.mark_down(key, repr(e), now)
+        return False
+
+    return replica_set.checked(key, float(lag or 0), now)
+
+
+def choose(tables, engines):
+    """Bind key of the replica to read tables from, or None for the primary."""
+    if not may_use_replica(tables):
+        return None
+
+    now = time.monotonic()
+
+    for key in replica_set.candidates(now):
+        if not replica_set.needs_check(key, now) or check(key, engines[key], now):
+            return key
+
+    return None
+
+
+@contextlib.contextmanager
+def on_primary():
+    """Keep every read in the block on the primary."""
+    token = pinned.set(True)
+
+    try:
+        yield
+    finally:
+        pinned.reset(token)
+
+
+class RoutingSession(Session):
+    """Sends the statements of a read routed to a replica to that replica's
+    engine, and remembers once the session has written anything."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        writing = self._flushing or getattr(clause, 'is_dml', False)
+
+        if writing:
+            self.info['wrote'] = True
+
+        key = current_replica.get()
+
+        if key != None and bind == None and not writing:
+            return self._db.engines[key]
+
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
@@ -1,28 +1,37 @@
-from flask import Flask, request
-from flask_restful import Resource, Api
-from flaskr.backend import login, logout, create_user, delete_user, modify_user, list_users, list_onlineusers
+from flask import Flask, Response, request
+from flask_restful import Resource, Api, abort
+from flaskr.backend import abort_if_rate_limited, login, logout, create_user, create_users, delete_user, delete_users, modify_user, modify_users, list_users, list_onlineusers, count_onlineusers, get_onlineuser
+from flaskr.pool import pool_stats
+import flaskr.metrics as metrics
+from flaskr.response_cache import cached_response
 from time import gmtime, strftime
+import json
 import logging
 
+
+logger = logging.getLogger(__name__)
+
 def get_current_datetime_string():
     return strftime("%Y-%m-%dT%H:%M:%S", gmtime())
 
 
 class Login(Resource):
     def post(self):
-        logging.info(f'POST /login: {request.form}')
+        logger.info('POST /login from %s', request.remote_addr)
+
+        abort_if_rate_limited(ip=request.remote_addr, username=request.form.get('username'))
 
         result = login(dict(request.form) | {
             'ip': request.remote_addr
         })
 
-        logging.info(f'Responding with the token: {result}')
+        logger.debug('Responding with the token: %s', result)
         return result, 200
 
 
 class Logout(Resource):
     def post(self):
-        logging.info(f'POST /logout: {request.form}')
+        logger.info('POST /logout')
 
         result = logout(dict(request.form))
 
@@ -31,23 +40,57 @@ class Logout(Resource):
 
 class UserList(Resource):
     def get(self):
-        logging.info(f'GET /user/list: {request.form}')
+        logger.info('GET /user/list: %s', request.args)
 
-        return list_users(), 200
+        return cached_response(['user'], lambda: list_users({
+            'limit': request.args.get('limit'),
+            'cursor': request.args.get('cursor'),
+            'fields': request.args.get('fields')
+        }))
 
 
 class UserCreate(Resource):
     def post(self):
-        logging.info(f'POST /user/create: {request.form}')
+        logger.info('POST /user/create')
 
         create_user(dict(request.form))
 
         return '', 204
 
 
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/ndjson')
+
+
+def read_ndjson(stream):
+    for line in stream:
+        if line.strip() == b'':
+            continue
+
+        try:
+            yield json.loads(line)
+        except ValueError:
+            # Reported as a failed row by create_users
+            yield None
+
+
+class UserBulkCreate(Resource):
+    def post(self):
+        logger.info('POST /user/bulk-create: %s', request.mimetype)
+
+        if request.mimetype in NDJSON_MIMETYPES:
+            users = read_ndjson(request.stream)
+        else:
+            users = request.get_json()
+
+            if not isinstance(users, list):
+                abort(400, message='Expected a JSON array or an NDJSON stream of users')
+
+        return create_users(users), 200
+
+
 class UserDelete(Resource):
     def post(self, id):
-        logging.info(f'POST /user/delete: {request.form}')
+        logger.info('POST /user/delete: %s', id)
 
         delete_user(dict(request.form) | {
             'id': id
@@ -58,7 +101,7 @@ class UserDelete(Resource):
 
 class UserUpdate(Resource):
     def post(self, id):
-        logging.info(f'POST /user/update: {request.form}')
+        logger.info('POST /user/update: %s', id)
 
         modify_user(dict(request.form) | {
             'id': id
@@ -67,10 +110,50 @@ class UserUpdate(Resource):
         return '', 204
 
 
+class UserBulkDelete(Resource):
+    def post(self):
+        logger.info('POST /user/delete')
+
+        return delete_users(request.get_json()), 200
+
+
+class UserBulkUpdate(Resource):
+    def post(self):
+        logger.info('POST /user/update')
+
+        modify_users(request.get_json())
+
+        return '', 204
+
+
 class OnlineUsers(Resource):
     def get(self):
-        logging.info(f'GET /onlineusers: {request.form}')
+        logger.info('GET /onlineusers')
 
-        result = list_onlineusers()
+        return cached_response(['session', 'user'], lambda: list_onlineusers({
+            'fields': request.args.get('fields')
+        }))
 
-        return result, 200
+
+class OnlineUserCount(Resource):
+    def get(self):
+        logger.info('GET /onlineusers/count')
+
+        return count_onlineusers(), 200
+
+
+class OnlineUser(Resource):
+    def get(self, id):
+        logger.info('GET /onlineusers: %s', id)
+
+        return get_onlineuser(id), 200
+
+
+class PoolMetrics(Resource):
+    def get(self):
+        return pool_stats(), 200
+
+
+class Metrics(Resource):
+    def get(self):
+        return Response(metrics.export(), mimetype='text/plain; version=0.0.4')
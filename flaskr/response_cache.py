@@ -0,0 +1,82 @@
+"""Conditional GET and response caching keyed by table versions.
+
+A response's ETag is derived from the versions of the tables it reads plus
+the query arguments, so it can be computed and compared against
+If-None-Match without touching the database. Rendered bodies are kept per
+worker under that ETag; a write bumps the version, which changes the ETag and
+orphans the old entry.
+
+Sessions also leave responses without a write, by expiring. The ETag of a
+response that reads the session table therefore also changes every
+expiry_interval seconds, so an expired session is listed at most that long;
+it's the touch interval, the precision last_seen_at is kept at anyway.
+"""
+from flask import Response, request
+from flaskr.cache import TTLCache
+from flaskr.representations import dumps
+import flaskr.versions as versions
+import hashlib
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+responses = TTLCache(max_size=256, ttl=300)
+
+# Tables whose rows drop out of responses as time passes
+EXPIRING_TABLES = ('session',)
+
+settings = {'expiry_interval': 60}
+
+
+def configure(max_size, ttl, expiry_interval):
+    responses.configure(max_size=max_size, ttl=ttl)
+    settings['expiry_interval'] = expiry_interval
+
+
+def make_etag(route, tables, args):
+    """args are the query arguments as (name, value) pairs."""
+    key = repr((route, sorted(args))).encode()
+    digest = hashlib.blake2b(key, digest_size=8).hexdigest()
+    state = '.'.join(str(version) for version in versions.current(*tables))
+
+    if any(table in EXPIRING_TABLES for table in tables):
+        period = int(time.time() // max(settings['expiry_interval'], 1))
+        state += f'.t{period:x}'
+
+    return f'{versions.epoch():x}-{state}-{digest}'
+
+
+def cached_body(etag):
+    """The rendered body stored under etag, or None."""
+    return responses.get(etag)
+
+
+def store(etag, result):
+    """Render result, keep it under etag and return the body."""
+    body = dumps(result)
+    responses.put(etag, body)
+
+    return body
+
+
+def cached_response(tables, compute):
+    """Serve the result of compute() for the current request, answering 304
+    when the client already has the current version."""
+    etag = make_etag(request.path, tables, request.args.items(multi=True))
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    body = cached_body(etag)
+
+    if body == None:
+        body = store(etag, compute())
+
+    response = Response(body, status=200, mimetype='application/json')
+    response.set_etag(etag)
+
+    return response
@@ -1,274 +1,263 @@
 import re
-import logging
-from flask_restful import abort
 
 
-def required(check):
-    logging.info(f'Checking required field {str(check.__name__).removeprefix("check_")} with: {check.__name__}')
+MAX_PAGE_SIZE = 1000
+MAX_BATCH_SIZE = 1000
 
-    def wrapper(*args):
-        assert len(args) >= 1, f'Internal error: The resulting function of the decorator {__name__} takes at least one argument'
 
-        data = args[0]
+def required(name, check):
+    return (name, check, True)
 
-        assert data != None, f'The {str(check.__name__).removeprefix("check_")} field can\'t be null.'
 
-        logging.info(f'Data isn\'t empty, sending to {check.__name__}...')
-        check(data)
-        logging.info('Passed the check!')
+def optional(name, check):
+    return (name, check, False)
 
-    return wrapper
 
+def compile_validator(fields):
+    """Build a single validator for a schema's field definitions.
 
-def optional(check):
-    logging.info(f'Checking optional field {str(check.__name__).removeprefix("check_")} with: {check.__name__}')
+    The validator runs each field check exactly once and returns a dict of
+    every failing field with its message, or None if the data is valid.
+    """
+    fields = tuple(fields)
 
-    def wrapper(*args):
-        assert len(args) >= 1, f'Internal error: The resulting function of the decorator {__name__} takes at least one argument'
-
-        data = args[0]
+    def validate(data):
+        errors = {}
 
-        if data == None:
-            logging.info('Data is empty, skipping the check!')
-        else:
-            logging.info(f'Data isn\'t empty, sending to {check.__name__}...')
-            check(data)
-            logging.info('Passed the check!')
+        for name, check, is_required in fields:
+            value = data.get(name)
 
-    return wrapper
+            if value == None:
+                if is_required:
+                    errors[name] = f'The {name} field can\'t be null.'
+                continue
 
+            try:
+                error = check(value)
+            except Exception as e:
+                error = repr(e)
 
-def validator(func):
-    def wrapper(*args):
-        assert len(args) == 1, f'Internal error: The resulting function of the decorator {__name__} takes exactly one argument'
+            if error != None:
+                errors[name] = error
 
-        data = args[0]
+        if len(errors) == 0:
+            return None
 
-        try:
-            func(data)
-        except AssertionError as e:
-            abort(500, message=str(e))
-        except Exception as e:
-            abort(500, message=repr(e))
-        
-        logging.info('Validated!')
+        return errors
 
-        return None
+    return validate
 
-    return wrapper
 
+def pattern_check(pattern, message):
+    match = re.compile(pattern).match
 
-def check_username(username):
-    logging.info('Validating username')
-    # Alphanumeric string that may include _ and – having a length of 3 to 16 characters
-    assert re.match(r"^[a-z0-9_-]{3,16}$", username), "Username must be alphanumeric, lowercase, between 3 to 16 characters   "
+    def check(value):
+        if match(value) == None:
+            return message.format(value)
 
+    return check
 
-def check_password(password):
-    logging.info('Validating password')
-    # Alphanumeric without space
-    assert re.match(r"^[a-zA-Z0-9]*$", password), "Password must be alphanumeric"
 
+# Alphanumeric string that may include _ and – having a length of 3 to 16 characters
+check_username = pattern_check(r"^[a-z0-9_-]{3,16}$", "Username must be alphanumeric, lowercase, between 3 to 16 characters")
 
-def check_ip(ip):
-    logging.info('Validating ip')
-    # IPv4 address
-    assert re.match(r"^(([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\.){3}([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])$", ip), "Only IPv4 is supported"
+# Alphanumeric without space
+check_password = pattern_check(r"^[a-zA-Z0-9]*$", "Password must be alphanumeric")
 
+# IPv4 address
+check_ip = pattern_check(r"^(([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\.){3}([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])$", "Only IPv4 is supported")
 
-def check_datetime(datetime):
-    logging.info('Validating datetime')
-    # ISO 8601 datetime string no seconds
-    assert re.match(r"\d{4}-[01]\d-[0-3]\dT[0-2]\d:[0-5]\d:[0-5]\d", datetime), f"Invalid datetime: ({datetime})"
+# ISO 8601 datetime string no seconds
+check_datetime = pattern_check(r"\d{4}-[01]\d-[0-3]\dT[0-2]\d:[0-5]\d:[0-5]\d", "Invalid datetime: ({})")
 
+# Common email Ids
+check_email = pattern_check(r"^([a-zA-Z0-9._%-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,6})*$", "Invalid email")
 
-def check_email(email):
-    logging.info('Validating email')
-    # Common email Ids
-    assert re.match(r"^([a-zA-Z0-9._%-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,6})*$", email), 'Invalid email'
+check_name = pattern_check(r"^[a-zA-Z]*$", "Invalid name")
 
+check_date = pattern_check(r"\d{4}-[01]\d-[0-3]\d", "Invalid date")
 
-def check_name(name):
-    logging.info('Validating name')
-    assert re.match(r"^[a-zA-Z]*$", name), "Invalid name"
+# Alphanumeric without space
+check_token = pattern_check(r"^[a-zA-Z0-9_-]*$", "Token must be alphanumeric")
 
+# URL-safe base64 without padding
+check_cursor = pattern_check(r"^[a-zA-Z0-9_-]+$", "Invalid cursor")
 
-def check_date(date):
-    logging.info('Validating date')
-    assert re.match("\d{4}-[01]\d-[0-3]\d", date), "Invalid date"
+# Comma-separated column names, e.g. id,username
+check_fields = pattern_check(r"^[a-z_]+(,[a-z_]+)*$", "Fields must be a comma-separated list of names")
 
 
 def check_id(id):
-    logging.info('Validating id')
     # A positive integer
-    assert type(id) == int and id > 0
+    if type(id) != int or id <= 0:
+        return 'Id must be a positive integer'
 
 
-def check_token(token):
-    logging.info('Validating token')
-    # Alphanumeric without space
-    assert re.match(r"^[a-zA-Z0-9_-]*$", token), "Token must be alphanumeric"
+def check_limit(limit):
+    # A positive integer no larger than the maximum page size, as a number or
+    # as the digits of a query argument
+    if type(limit) == str and re.fullmatch('[0-9]{1,9}', limit):
+        limit = int(limit)
 
+    if type(limit) != int or not 0 < limit <= MAX_PAGE_SIZE:
+        return f'Limit must be between 1 and {MAX_PAGE_SIZE}'
 
-class LoginFormSchema():
-    @validator
-    def validate(data):
-        required(check_username)(data.get('username'))
-        required(check_password)(data.get('password'))
-        required(check_ip)(data.get('ip'))
 
-    def serialize(data):
-        logging.info(f'Serializing the data: {data}')
+def check_ids(ids):
+    # A non-empty list of positive integers
+    if type(ids) != list or not 0 < len(ids) <= MAX_BATCH_SIZE:
+        return f'Ids must be a list of 1 to {MAX_BATCH_SIZE} ids'
 
-        if LoginFormSchema.validate(data) != None:
-            return None
-        
-        return {
-            'username': data.get('username'),
-            'password': data.get('password'),
-            'ip': data.get('ip')
-        }
+    for id in ids:
+        if check_id(id) != None:
+            return f'Invalid id: {id}'
 
 
-class SessionDataSchema():
-    @validator
-    def validate(data):
-        required(check_datetime)(data.get('created_at'))
-        required(check_ip)(data.get('ip'))
-        required(check_id)(data.get('user_id'))
-        required(check_token)(data.get('token'))
+def check_user_patches(patches):
+    # A non-empty list of UserPatchSchema objects
+    if type(patches) != list or not 0 < len(patches) <= MAX_BATCH_SIZE:
+        return f'Users must be a list of 1 to {MAX_BATCH_SIZE} objects'
 
-    def serialize(data):
-        logging.info(f'Serializing the data: {data}')
+    errors = {}
 
-        if SessionDataSchema.validate(data) != None:
-            return None
-        
-        return {
-            'created_at': data.get('created_at'),
-            'ip': data.get('ip'),
-            'user_id': data.get('user_id'),
-            'token': data.get('token')
-        }
+    for index, patch in enumerate(patches):
+        if type(patch) != dict:
+            errors[index] = 'Must be an object'
+            continue
 
+        result = UserPatchSchema.validate(patch)
 
-class TokenDataSchema():
-    @validator
-    def validate(data):
-        required(check_token)(data.get('token'))
+        if result != None:
+            errors[index] = result
 
-    def serialize(data):
-        logging.info(f'Serializing the data: {data}')
+    if len(errors) > 0:
+        return errors
 
-        if TokenDataSchema.validate(data) != None:
-            return None
-        
-        return {
-            'token': data.get('token')
-        }
 
+class Schema():
+    """Declarative schema: subclasses list their fields, which are compiled
+    into a single validator once, when the class is defined."""
 
-class NewUserDataSchema():
-    @validator
-    def validate(data):
-        required(check_username)(data.get('username'))
-        required(check_email)(data.get('email'))
-        required(check_password)(data.get('password'))
-        optional(check_name)(data.get('firstname'))
-        optional(check_name)(data.get('middlename'))
-        optional(check_name)(data.get('lastname'))
-        optional(check_date)(data.get('birthdate'))
-        optional(check_id)(data.get('id'))
-    
-    def serialize(data):
-        logging.info(f'Serializing the data: {data}')
-
-        if NewUserDataSchema.validate(data) != None:
-            return None
-        
-        return {
-            'username': data.get('username'),
-            'email': data.get('email'),
-            'password': data.get('password'),
-            'firstname': data.get('firstname'),
-            'middlename': data.get('middlename'),
-            'lastname': data.get('lastname'),
-            'birthdate': data.get('birthdate'),
-            'id': data.get('id')
-        }
-
-
-class UserDataSchema():
-    @validator
-    def validate(data):
-        optional(check_username)(data.get('username'))
-        optional(check_email)(data.get('email'))
-        optional(check_password)(data.get('password'))
-        optional(check_name)(data.get('firstname'))
-        optional(check_name)(data.get('middlename'))
-        optional(check_name)(data.get('lastname'))
-        optional(check_date)(data.get('birthdate'))
-        optional(check_id)(data.get('id'))
-    
-    def serialize(data):
-        logging.info(f'Serializing the data: {data}')
-
-        if UserDataSchema.validate(data) != None:
-            return None
-        
-        return {
-            'username': data.get('username'),
-            'email': data.get('email'),
-            'password': data.get('password'),
-            'firstname': data.get('firstname'),
-            'middlename': data.get('middlename'),
-            'lastname': data.get('lastname'),
-            'birthdate': data.get('birthdate'),
-            'id': data.get('id')
-        }
-
-
-class UserDeletionSchema():
-    @validator
-    def validate(data):
-        required(check_token)(data.get('token'))
-        required(check_id)(data.get('id'))
-    
-    def serialize(data):
-        logging.info(f'Serializing the data: {data}')
+    fields = ()
 
-        if UserDeletionSchema.validate(data) != None:
-            return None
-        
-        return {
-            'token': data.get('token'),
-            'id': data.get('id')
-        }
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
 
+        cls.names = tuple(name for name, _, _ in cls.fields)
+        cls.validator = staticmethod(compile_validator(cls.fields))
 
-class UserModificationSchema():
-    @validator
-    def validate(data):
-        required(check_token)(data.get('token'))
-        optional(check_name)(data.get('firstname'))
-        optional(check_name)(data.get('middlename'))
-        optional(check_name)(data.get('lastname'))
-        optional(check_date)(data.get('birthdate'))
-        optional(check_email)(data.get('email'))
-        required(check_id)(data.get('id'))
-    
-    def serialize(data):
-        logging.info(f'Serializing the data: {data}')
-
-        if UserModificationSchema.validate(data) != None:
-            return None
-        
-        return {
-            'token': data.get('token'),
-            'firstname': data.get('firstname'),
-            'middlename': data.get('middlename'),
-            'lastname': data.get('lastname'),
-            'birthdate': data.get('birthdate'),
-            'email': data.get('email'),
-            'id': data.get('id')
-        }
+    @classmethod
+    def validate(cls, data):
+        return cls.validator(data)
+
+    @classmethod
+    def serialize(cls, data):
+        """Project already validated data onto the schema's fields."""
+        return {name: data.get(name) for name in cls.names}
+
+
+class ListPageSchema(Schema):
+    fields = (
+        optional('limit', check_limit),
+        optional('cursor', check_cursor),
+        optional('fields', check_fields)
+    )
+
+
+class FieldSelectionSchema(Schema):
+    fields = (
+        optional('fields', check_fields),
+    )
+
+
+class LoginFormSchema(Schema):
+    fields = (
+        required('username', check_username),
+        required('password', check_password),
+        required('ip', check_ip)
+    )
+
+
+class SessionDataSchema(Schema):
+    fields = (
+        required('created_at', check_datetime),
+        required('ip', check_ip),
+        required('user_id', check_id),
+        required('token', check_token)
+    )
+
+
+class TokenDataSchema(Schema):
+    fields = (
+        required('token', check_token),
+    )
+
+
+class NewUserDataSchema(Schema):
+    fields = (
+        required('username', check_username),
+        required('email', check_email),
+        required('password', check_password),
+        optional('firstname', check_name),
+        optional('middlename', check_name),
+        optional('lastname', check_name),
+        optional('birthdate', check_date),
+        optional('id', check_id)
+    )
+
+
+class UserDataSchema(Schema):
+    fields = (
+        optional('username', check_username),
+        optional('email', check_email),
+        optional('password', check_password),
+        optional('firstname', check_name),
+        optional('middlename', check_name),
+        optional('lastname', check_name),
+        optional('birthdate', check_date),
+        optional('id', check_id)
+    )
+
+
+class UserDeletionSchema(Schema):
+    fields = (
+        required('token', check_token),
+        required('id', check_id)
+    )
+
+
+class UserModificationSchema(Schema):
+    fields = (
+        required('token', check_token),
+        optional('firstname', check_name),
+        optional('middlename', check_name),
+        optional('lastname', check_name),
+        optional('birthdate', check_date),
+        optional('email', check_email),
+        required('id', check_id)
+    )
+
+
+class UserPatchSchema(Schema):
+    fields = (
+        optional('firstname', check_name),
+        optional('middlename', check_name),
+        optional('lastname', check_name),
+        optional('birthdate', check_date),
+        optional('email', check_email),
+        required('id', check_id)
+    )
+
+
+class UserBulkDeletionSchema(Schema):
+    fields = (
+        required('token', check_token),
+        required('ids', check_ids)
+    )
+
+
+class UserBulkModificationSchema(Schema):
+    fields = (
+        required('token', check_token),
+        required('users', check_user_patches)
+    )
@@ -0,0 +1,130 @@
+"""File-backed shared memory for state that every worker on a host must see.
+
+uWSGI workers are separate processes, so counters and tables they share
+live in a small memory-mapped file. Each process maps it once (again after a
+fork, so it has its own descriptor to lock with) and serializes writers with
+an exclusive flock. A flock belongs to the descriptor, which all threads of
+a process share, so a thread lock serializes them first.
+
+The files default to a runtime directory only this user can enter, since a
+file planted under a predictable name in a shared temp directory would be
+mapped, and trusted, in place of ours. They're never opened through a
+symlink, wherever they're configured to live.
+"""
+import contextlib
+import fcntl
+import logging
+import mmap
+import os
+import stat
+import tempfile
+import threading
+import weakref
+
+
+logger = logging.getLogger(__name__)
+
+
+def runtime_dir():
+    """$XDG_RUNTIME_DIR/flaskr, or flaskr-<uid> in the temp directory."""
+    base = os.environ.get('XDG_RUNTIME_DIR')
+
+    if base:
+        return os.path.join(base, 'flaskr')
+
+    return os.path.join(tempfile.gettempdir(), f'flaskr-{os.getuid()}')
+
+
+def runtime_path(name):
+    """Default location of a shared file; see open_file."""
+    return os.path.join(runtime_dir(), name)
+
+
+def make_runtime_dir():
+    path = runtime_dir()
+
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+
+    status = os.lstat(path)
+
+    if not stat.S_ISDIR(status.st_mode) or status.st_uid != os.getuid() or status.st_mode & 0o077:
+        raise PermissionError(f'{path} must be a directory that only its owner, uid {os.getuid()}, can access')
+
+
+def open_file(path, flags):
+    """os.open a shared file, creating it 0600 if need be and refusing a
+    symlink. The runtime directory is created first when it's the file's."""
+    if os.path.dirname(path) == runtime_dir():
+        make_runtime_dir()
+
+    return os.open(path, flags | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+
+
+# Every SharedMemory, so a forked child can replace their thread locks
+instances = weakref.WeakSet()
+
+
+class SharedMemory():
+    def __init__(self, path, size, initialize=None):
+        """initialize(fd) runs, under the lock, when the file is created or
+        is smaller than size; the new bytes are zeroed before it runs."""
+        self.path = path
+        self.size = size
+        self.initialize = initialize
+        self._map = None
+        self._fd = None
+        self._pid = None
+        # Reentrant, as lock() opens the file under it
+        self._thread_lock = threading.RLock()
+        instances.add(self)
+
+    def open(self):
+        with self._thread_lock:
+            if self._map != None and self._pid == os.getpid():
+                return self._map
+
+            return self._open()
+
+    def _open(self):
+        fd = open_file(self.path, os.O_RDWR)
+
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size < self.size:
+                os.ftruncate(fd, self.size)
+
+                if self.initialize != None:
+                    self.initialize(fd)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+        self._fd = fd
+        self._map = mmap.mmap(fd, self.size)
+        self._pid = os.getpid()
+
+        return self._map
+
+    @contextlib.contextmanager
+    def lock(self):
+        """Map the file and hold the exclusive lock for the block."""
+        with self._thread_lock:
+            memory = self.open()
+
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield memory
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+def reset_thread_locks():
+    # A lock held by another thread at the fork stays held in the child,
+    # where that thread doesn't exist
+    for memory in list(instances):
+        memory._thread_lock = threading.RLock()
+
+
+os.register_at_fork(after_in_child=reset_thread_locks)
@@ -0,0 +1,131 @@
+"""Background deletion of expired sessions.
+
+Expired sessions are already rejected at lookup; the sweeper keeps the
+session table from growing by deleting them in small batches, oldest first,
+each in its own short transaction. Every worker runs a sweeper thread (a
+task on the event loop in the ASGI mode), and a non-blocking file lock lets
+only one of them sweep at a time.
+"""
+from flaskr.database import Session, delete_expired_sessions, session_expiry
+from flaskr.pool import after_fork
+from flaskr.shared import open_file
+import contextlib
+import datetime as dt
+import fcntl
+import logging
+import os
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+def expired_cutoffs(now):
+    """(column, cutoff) for each expiry limit that's set; sessions with the
+    column below the cutoff have expired."""
+    for column, cutoff in (
+        (Session.created_at, session_expiry.created_cutoff(now)),
+        (Session.last_seen_at, session_expiry.seen_cutoff(now))
+    ):
+        if cutoff != None:
+            yield column, cutoff
+
+
+@contextlib.contextmanager
+def sweep_lock(path):
+    """Yields whether this process holds the sweep lock for the block; when
+    another one does, it's sweeping and this one should skip the round."""
+    # Opened per round: a descriptor inherited across fork would share
+    # the lock with the parent
+    with os.fdopen(open_file(path, os.O_WRONLY | os.O_APPEND), 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+
+        yield True
+
+
+def sweep_expired_sessions(batch_size, now=None):
+    """Delete every expired session, batch_size rows per transaction.
+    Returns the number deleted."""
+    total = 0
+
+    for column, cutoff in expired_cutoffs(now or dt.datetime.now()):
+        while True:
+            deleted = delete_expired_sessions(column, cutoff, batch_size)
+            total += deleted
+
+            if deleted < batch_size:
+                break
+
+    return total
+
+
+class SessionSweeper():
+    def __init__(self, app, interval, batch_size, lock_path):
+        self.app = app
+        self.interval = interval
+        self.batch_size = batch_size
+        self.lock_path = lock_path
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        # A fresh event, since the old one may be mid-wait in a forked parent
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, name='session-sweeper', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sweep_once()
+            except Exception:
+                logger.exception('Session sweep failed')
+
+    def sweep_once(self):
+        with sweep_lock(self.lock_path) as locked:
+            if not locked:
+                return 0
+
+            with self.app.app_context():
+                deleted = sweep_expired_sessions(self.batch_size)
+
+        if deleted > 0:
+            logger.info('Swept %d expired sessions', deleted)
+
+        return deleted
+
+
+sweeper = None
+
+
+def start_sweeper(app):
+    global sweeper
+
+    if not app.config['SESSION_SWEEP_INTERVAL']:
+        return None
+
+    sweeper = SessionSweeper(
+        app=app,
+        interval=app.config['SESSION_SWEEP_INTERVAL'],
+        batch_size=app.config['SESSION_SWEEP_BATCH_SIZE'],
+        lock_path=app.config['SESSION_SWEEP_LOCK_PATH']
+    )
+    sweeper.start()
+
+    return sweeper
+
+
+def restart_sweeper_after_fork():
+    # Threads don't survive fork; each worker starts its own
+    if sweeper != None:
+        sweeper.start()
+
+
+after_fork(restart_sweeper_after_fork)
@@ -0,0 +1,201 @@
+"""Stateless signed session tokens.
+
+With TOKEN_MODE set to 'signed', login hands out a token carrying the user
+id, session id and expiry, signed with HMAC-SHA256 under TOKEN_SECRET,
+instead of a random one that has to be looked up in the session table.
+Checking it is pure CPU. The session row is still written at login, so
+/onlineusers and the one-session-per-user rule work as before, but requests
+no longer touch it: the sweeper removes it after SESSION_IDLE_TIMEOUT while
+the token stays valid for SESSION_TTL unless it's revoked.
+
+Revocation goes through a denylist shared by every worker on the host. An
+entry names a session or a user and a time: that key's tokens expiring no
+later than it are rejected. Revoking a session enters its token's expiry,
+and revoking a user enters now + SESSION_TTL, which covers every token
+issued so far but none issued later. Entries die when their time passes,
+so the table only holds revocations that still matter. If a probe window is
+full of live entries, the one evicted raises a floor that rejects every
+token expiring before it: rejecting too much is safe, forgetting a
+revocation isn't.
+"""
+from flaskr.shared import SharedMemory
+import base64
+import binascii
+import hashlib
+import hmac
+import logging
+import struct
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# user id, session id, expiry (unix seconds)
+PAYLOAD = struct.Struct('>QQQ')
+
+# Truncated HMAC-SHA256
+MAC_SIZE = 16
+
+# key hash, revoked until (unix seconds); slot 0 holds the floor
+SLOT = struct.Struct('Qd')
+
+PROBE_WINDOW = 8
+
+
+def key_hash(key):
+    # 0 marks an empty slot
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') or 1
+
+
+class Denylist():
+    def __init__(self, path, slots):
+        self.slots = slots
+        self.memory = SharedMemory(path, SLOT.size * (1 + slots))
+
+    def offset(self, index):
+        return SLOT.size * (1 + index)
+
+    def revoke(self, key, until, now=None):
+        now = now if now != None else time.time()
+        hashed = key_hash(key)
+        start = hashed % self.slots
+
+        with self.memory.lock() as memory:
+            window = [(start + step) % self.slots for step in range(PROBE_WINDOW)]
+            slots = [(index, *SLOT.unpack_from(memory, self.offset(index))) for index in window]
+
+            for index, slot_key, slot_until in slots:
+                if slot_key == hashed:
+                    SLOT.pack_into(memory, self.offset(index), hashed, max(until, slot_until))
+                    return
+
+            for index, slot_key, slot_until in slots:
+                # Dead entries stay keyed so lookups keep probing past them
+                if slot_key == 0 or slot_until <= now:
+                    SLOT.pack_into(memory, self.offset(index), hashed, until)
+                    return
+
+            index, _, evicted_until = min(slots, key=lambda slot: slot[2])
+            _, floor = SLOT.unpack_from(memory, 0)
+            SLOT.pack_into(memory, 0, 0, max(floor, evicted_until))
+            SLOT.pack_into(memory, self.offset(index), hashed, until)
+
+        logger.warning('Token denylist is full around slot %d; rejecting every token expiring before %s', index, evicted_until)
+
+    def is_revoked(self, keys, expires):
+        with self.memory.lock() as memory:
+            if expires <= SLOT.unpack_from(memory, 0)[1]:
+                return True
+
+            for key in keys:
+                hashed = key_hash(key)
+                start = hashed % self.slots
+
+                for step in range(PROBE_WINDOW):
+                    slot_key, slot_until = SLOT.unpack_from(memory, self.offset((start + step) % self.slots))
+
+                    if slot_key == hashed:
+                        if expires <= slot_until:
+                            return True
+                        break
+
+                    if slot_key == 0:
+                        break
+
+        return False
+
+
+class TokenSigner():
+    def __init__(self, secret, ttl):
+        self.secret = secret
+        self.ttl = ttl
+
+    def mac(self, payload):
+        return hmac.new(self.secret, payload, hashlib.sha256).digest()[:MAC_SIZE]
+
+    def issue(self, user_id, session_id, now=None):
+        now = now if now != None else time.time()
+        payload = PAYLOAD.pack(user_id, session_id, int(now + self.ttl))
+
+        # Unpadded base64url, which the token schema accepts
+        return base64.urlsafe_b64encode(payload + self.mac(payload)).decode().rstrip('=')
+
+    def verify(self, token, now=None):
+        """Return the session the token was issued for, as a dict like a
+        session row's, or None if it's malformed, forged or expired."""
+        now = now if now != None else time.time()
+
+        try:
+            raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        except (binascii.Error, ValueError):
+            return None
+
+        if len(raw) != PAYLOAD.size + MAC_SIZE:
+            return None
+
+        payload = raw[:PAYLOAD.size]
+
+        if not hmac.compare_digest(raw[PAYLOAD.size:], self.mac(payload)):
+            return None
+
+        user_id, session_id, expires = PAYLOAD.unpack(payload)
+
+        if expires <= now:
+            return None
+
+        return {
+            'id': session_id,
+            'user_id': user_id,
+            'expires': expires
+        }
+
+
+signer = None
+denylist = None
+
+
+def configure(mode, secret, ttl, denylist_path, denylist_slots):
+    global signer, denylist
+
+    if mode != 'signed':
+        signer = None
+        return
+
+    if ttl == None:
+        raise ValueError('Signed tokens need SESSION_TTL to be set')
+
+    if not secret:
+        # A random one per process would reject tokens signed by the others
+        raise ValueError('Signed tokens need TOKEN_SECRET to be set')
+
+    signer = TokenSigner(secret.encode() if isinstance(secret, str) else secret, ttl)
+    denylist = Denylist(denylist_path, denylist_slots)
+
+
+def enabled():
+    return signer != None
+
+
+def issue(user_id, session_id):
+    return signer.issue(user_id, session_id)
+
+
+def verify(token):
+    session = signer.verify(token)
+
+    if session == None:
+        return None
+
+    if denylist.is_revoked([f'session:{session["id"]}', f'user:{session["user_id"]}'], session['expires']):
+        return None
+
+    return session
+
+
+def revoke_session(session):
+    denylist.revoke(f'session:{session["id"]}', session['expires'])
+
+
+def revoke_user(user_id):
+    # Every token issued until now expires within ttl
+    denylist.revoke(f'user:{user_id}', time.time() + signer.ttl)
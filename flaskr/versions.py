@@ -0,0 +1,85 @@
+"""Per-table version counters shared by every worker on the host.
+
+The counters live in a small memory-mapped file, so a write in one uWSGI
+worker is visible to the others without a database round trip. The file
+also holds a random epoch, so versions from a recreated file never collide
+with ETags handed out before, and when each table was last written, which
+tells whether a read replica may still be behind.
+"""
+from flaskr.shared import SharedMemory, runtime_path
+import logging
+import os
+import secrets
+import struct
+import time
+
+
+logger = logging.getLogger(__name__)
+
+TABLES = ('user', 'session')
+
+SLOT = struct.Struct('Q')
+
+# Unix time of a table's last write, stored after the version slots; not
+# monotonic, as the file can outlive a reboot, which resets that clock
+WRITTEN = struct.Struct('d')
+
+
+def write_epoch(fd):
+    os.pwrite(fd, SLOT.pack(secrets.randbits(63)), 0)
+
+
+class TableVersions():
+    def __init__(self, path):
+        self.memory = SharedMemory(path, SLOT.size * (1 + len(TABLES)) + WRITTEN.size * len(TABLES), initialize=write_epoch)
+
+    def epoch(self):
+        return SLOT.unpack_from(self.memory.open(), 0)[0]
+
+    def get(self, table):
+        return SLOT.unpack_from(self.memory.open(), self.offset(table))[0]
+
+    def bump(self, table):
+        offset = self.offset(table)
+
+        with self.memory.lock() as memory:
+            SLOT.pack_into(memory, offset, SLOT.unpack_from(memory, offset)[0] + 1)
+            WRITTEN.pack_into(memory, self.written_offset(table), time.time())
+
+    def written_at(self, table):
+        return WRITTEN.unpack_from(self.memory.open(), self.written_offset(table))[0]
+
+    def offset(self, table):
+        return SLOT.size * (1 + TABLES.index(table))
+
+    def written_offset(self, table):
+        return SLOT.size * (1 + len(TABLES)) + WRITTEN.size * TABLES.index(table)
+
+
+table_versions = TableVersions(runtime_path('versions'))
+
+
+def configure(path):
+    global table_versions
+
+    table_versions = TableVersions(path)
+
+
+def bump(*tables):
+    # Called after the write commits, so readers never cache pre-commit data
+    # under the new version
+    for table in tables:
+        table_versions.bump(table)
+
+
+def current(*tables):
+    return [table_versions.get(table) for table in tables]
+
+
+def epoch():
+    return table_versions.epoch()
+
+
+def seconds_since_write(*tables):
+    """Time since any of the tables was last written by a worker on this host."""
+    return time.time() - max(table_versions.written_at(table) for table in tables)
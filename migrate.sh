@@ -0,0 +1 @@
+flask --app flaskr migrate
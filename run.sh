@@ -1 +1 @@
-flask --app flaskr run --debug
+QUERY_BUDGET_MODE=raise flask --app flaskr run --debug
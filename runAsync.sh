@@ -0,0 +1 @@
+uvicorn asgi:app --workers 5
@@ -0,0 +1 @@
+cp -n primary.db replica.db; DATABASE_URL=sqlite:///$PWD/primary.db DATABASE_REPLICA_URLS=sqlite:///$PWD/replica.db flask --app flaskr run --debug
@@ -0,0 +1,122 @@
+"""Shared-memory state updated from many threads of one process, as the
+request threads and the sweeper thread of a uWSGI worker do."""
+from flaskr.presence import HEADER, PresenceRegistry
+from flaskr.ratelimit import RateLimiter, key_hash, SLOT
+from flaskr.shared import SharedMemory
+from flaskr.tokens import Denylist
+from flaskr.versions import TableVersions
+import pytest
+import struct
+import sys
+import threading
+
+
+THREADS = 8
+
+
+@pytest.fixture(autouse=True)
+def frequent_thread_switches():
+    # Switch threads often enough to land inside the critical sections
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+
+    try:
+        yield
+    finally:
+        sys.setswitchinterval(interval)
+
+
+def run_threads(target, count=THREADS):
+    threads = [threading.Thread(target=target, args=(index,)) for index in range(count)]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_lock_serializes_threads(tmp_path):
+    counter = struct.Struct('Q')
+    memory = SharedMemory(str(tmp_path / 'counter'), counter.size)
+
+    def increment(index):
+        for _ in range(5000):
+            with memory.lock() as mapped:
+                counter.pack_into(mapped, 0, counter.unpack_from(mapped, 0)[0] + 1)
+
+    run_threads(increment)
+
+    with memory.lock() as mapped:
+        assert counter.unpack_from(mapped, 0)[0] == THREADS * 5000
+
+
+def test_rate_limiter_charges_every_allowed_request(tmp_path):
+    limiter = RateLimiter(str(tmp_path / 'ratelimit'), slots=64)
+    burst = 1000000
+    allowed = []
+
+    def charge(index):
+        results = [limiter.acquire([('ip:127.0.0.1', burst, 0.0)], now=0.0) for _ in range(5000)]
+        allowed.append(sum(1 for retry_after in results if retry_after == None))
+
+    run_threads(charge)
+
+    with limiter.memory.lock() as memory:
+        index, found = limiter.find_slot(memory, key_hash('ip:127.0.0.1'))
+        tokens = SLOT.unpack_from(memory, index * SLOT.size)[1]
+
+    assert found
+    assert sum(allowed) == THREADS * 5000
+    assert tokens == burst - THREADS * 5000
+
+
+def test_presence_count_matches_slots(tmp_path):
+    registry = PresenceRegistry(str(tmp_path / 'presence'), slots=1 << 12)
+    registry.rebuild(lambda: [])
+
+    def churn(index):
+        # Each thread adds and removes its own users, so every pair balances
+        user_ids = range(index * 100 + 1, index * 100 + 101)
+
+        for _ in range(20):
+            registry.add(user_ids)
+            registry.discard(user_ids)
+
+        registry.add(user_ids[:10])
+
+    run_threads(churn)
+
+    with registry.memory.lock() as memory:
+        count = HEADER.unpack_from(memory, 0)[0]
+        occupied = sum(1 for index in range(registry.slots) if registry.get(memory, index) != 0)
+
+    assert count == occupied == THREADS * 10
+    assert registry.count() == THREADS * 10
+
+
+def test_concurrent_version_bumps_all_count(tmp_path):
+    versions = TableVersions(str(tmp_path / 'versions'))
+    start = versions.get('user')
+
+    def bump(index):
+        for _ in range(2000):
+            versions.bump('user')
+
+    run_threads(bump)
+
+    assert versions.get('user') == start + THREADS * 2000
+
+
+def test_concurrent_revocations_are_all_kept(tmp_path):
+    denylist = Denylist(str(tmp_path / 'denylist'), slots=1024)
+    keys = [f'session:{id}' for id in range(THREADS * 20)]
+
+    def revoke(index):
+        for key in keys[index::THREADS]:
+            denylist.revoke(key, until=100.0, now=0.0)
+            # Lookups interleave with the writes, as requests verify tokens
+            denylist.is_revoked([key], expires=50.0)
+
+    run_threads(revoke)
+
+    assert [key for key in keys if not denylist.is_revoked([key], expires=50.0)] == []
@@ -1,8 +1,6 @@
-import logging
+from flaskr import create_app
 
-logging.basicConfig(level=logging.DEBUG)
-
-from flaskr import app
+app = create_app()
 
 if __name__ == "__main__":
     app.run()